@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+#  -*- Mode: python; coding: utf-8; indent-tabs-mode: nil -*- */
+#
+#  This file is part of systemd.
+#
+#  systemd is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+#
+#  systemd is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with systemd; If not, see <http://www.gnu.org/licenses/>.
+
+"""Benchmarks for parse_hwdb.py
+
+The parsers and checks are run on synthetic hwdb files, whose size is
+set with --groups and --files. The checks are also run on a real file,
+60-keyboard.hwdb unless --file is given, and the ids and trie
+benchmarks use the real hwdb files next to this script. Each benchmark
+reports the best time of --repeat runs, as text or with --json as a
+JSON document.
+"""
+
+import argparse
+import glob
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+import parse_hwdb
+
+HWDB_DIR = os.path.dirname(os.path.abspath(sys.argv[0]))
+
+VENDORS = ('Acer', 'ASUSTeK', 'Dell Inc.', 'Hewlett-Packard', 'LENOVO',
+           'SAMSUNG ELECTRONICS CO., LTD.', 'Sony Corporation', 'TOSHIBA',
+           'FUJITSU', 'Micro-Star International', 'Notebook', 'Google')
+KEYS = ('prog1', 'prog2', 'prog3', 'wlan', 'bluetooth', 'brightnessup',
+        'brightnessdown', 'screenlock', 'switchvideomode', 'battery',
+        'touchpad_toggle', 'micmute', 'help', 'setup', 'media', 'f21', 'fn',
+        'reserved', 'unknown', 'volumeup', 'volumedown', 'mute')
+
+def _vendor(rnd):
+    return rnd.choice(VENDORS).replace(' ', '*')
+
+def _gen_atkbd(rnd, n):
+    matches = ['evdev:atkbd:dmi:bvn*:bvr*:bd*:svn{}*:pn*{}{:05d}*:pvr*'
+               .format(_vendor(rnd), rnd.choice('ABCGMNTX'), n + i)
+               for i in range(rnd.choice((1, 1, 1, 1, 2, 2, 3)))]
+    codes = rnd.sample(range(0x80, 0x100), rnd.choice((1, 2, 2, 3, 4, 6, 8, 12)))
+    props = ['KEYBOARD_KEY_{:02x}={}'.format(code, rnd.choice(KEYS)) for code in sorted(codes)]
+    return matches, props
+
+def _gen_keyboard_usb(rnd, n):
+    matches = ['evdev:input:b0003v{:04X}p{:04X}*'.format(rnd.randrange(0x10000), (n + i) % 0x10000)
+               for i in range(rnd.choice((1, 1, 2)))]
+    codes = rnd.sample(range(0x70000, 0x70100), rnd.choice((1, 2, 4)))
+    props = ['KEYBOARD_KEY_{:x}={}'.format(code, rnd.choice(KEYS)) for code in sorted(codes)]
+    return matches, props
+
+def _abs(rnd, low, high):
+    return '{}:{}:{}'.format(rnd.randrange(1000, 2000), rnd.randrange(low, high), rnd.randrange(30, 80))
+
+def _gen_evdev_abs(rnd, n):
+    matches = ['evdev:name:SynPS/2 Synaptics TouchPad:dmi:*svn{}*:pn*{:05d}*'.format(_vendor(rnd), n)]
+    props = ['EVDEV_ABS_00=' + _abs(rnd, 5000, 6000),
+             'EVDEV_ABS_01=' + _abs(rnd, 4000, 5000)]
+    if rnd.random() < 0.5:
+        props += ['EVDEV_ABS_35=' + _abs(rnd, 5000, 6000),
+                  'EVDEV_ABS_36=' + _abs(rnd, 4000, 5000)]
+    return matches, props
+
+def _gen_mouse(rnd, n):
+    vendor = rnd.randrange(0x10000)
+    matches = ['mouse:usb:v{:04x}p{:04x}:name:{} Mouse {}:'
+               .format(vendor, (n + i) % 0x10000, rnd.choice(VENDORS), n + i)
+               for i in range(rnd.choice((1, 1, 1, 2)))]
+    dpis = sorted(rnd.sample((400, 800, 1000, 1200, 1600, 2400, 3200, 4000), rnd.choice((1, 1, 3, 5))))
+    default = rnd.randrange(len(dpis)) if len(dpis) > 1 else None
+    props = ['MOUSE_DPI=' + ' '.join('{}{}@125'.format('*' if i == default else '', dpi)
+                                     for i, dpi in enumerate(dpis))]
+    if rnd.random() < 0.2:
+        props += ['MOUSE_WHEEL_CLICK_ANGLE={}'.format(rnd.choice((15, 18, 20, 24)))]
+    return matches, props
+
+def _gen_sensor(rnd, n):
+    matches = ['sensor:modalias:acpi:BMA250*:dmi:*svn{}*:pn*{:05d}*'.format(_vendor(rnd), n)]
+    props = ['ACCEL_MOUNT_MATRIX=' + rnd.choice(('0, 1, 0; -1, 0, 0; 0, 0, 1',
+                                                 '-1, 0, 0; 0, -1, 0; 0, 0, 1',
+                                                 '0, -1, 0; 1, 0, 0; 0, 0, 1'))]
+    return matches, props
+
+def _gen_touchpad(rnd, n):
+    matches = ['touchpad:usb:v{:04x}p{:04x}:*'.format(rnd.randrange(0x10000), n % 0x10000)]
+    props = ['ID_INPUT_TOUCHPAD_INTEGRATION=' + rnd.choice(('internal', 'external'))]
+    return matches, props
+
+# (weight, generator) pairs, the weights roughly follow the mix of
+# entries in the [67]0-*.hwdb files
+GENERATORS = ((40, _gen_atkbd),
+              (10, _gen_keyboard_usb),
+              (10, _gen_evdev_abs),
+              (30, _gen_mouse),
+              (5, _gen_sensor),
+              (5, _gen_touchpad))
+
+def generate_hwdb(fname, ngroups, seed):
+    "Write ngroups random but valid match groups to fname"
+    rnd = random.Random(seed)
+    weights = [weight for weight, gen in GENERATORS]
+    gens = [gen for weight, gen in GENERATORS]
+    with open(fname, 'w', encoding='UTF-8') as f:
+        f.write('# This file was generated by bench_hwdb.py\n\n')
+        for n in range(ngroups):
+            gen, = rnd.choices(gens, weights)
+            # matches are numbered so that they are unique across files
+            matches, props = gen(rnd, (seed * ngroups + n) * 4)
+            if rnd.random() < 0.3:
+                f.write('# {} model {}\n'.format(rnd.choice(VENDORS), n))
+            for match in matches:
+                f.write(match + '\n')
+            for prop in props:
+                f.write(' ' + prop + '\n')
+            f.write('\n')
+
+def count_lines(files):
+    nlines = 0
+    for fname in files:
+        with open(fname, 'rb') as f:
+            nlines += sum(1 for line in f)
+    return nlines
+
+def timed(repeat, func):
+    "Return the best time out of repeat calls to func"
+    return min(timeit.repeat(func, repeat=repeat, number=1))
+
+def result(name, seconds, items, unit):
+    return {'name': name,
+            'seconds': seconds,
+            'items': items,
+            'unit': unit,
+            'per_item_us': seconds * 1e6 / items if items else None}
+
+def bench_parse(files, repeat):
+    nlines = count_lines(files)
+    yield result('parse_reference',
+                 timed(repeat, lambda: [parse_hwdb.parse_reference(f, []) for f in files]),
+                 nlines, 'lines')
+    yield result('parse',
+                 timed(repeat, lambda: [parse_hwdb.parse(f, []) for f in files]),
+                 nlines, 'lines')
+
+def bench_checks(files, repeat, label=''):
+    groups = [group for fname in files for group in parse_hwdb.parse(fname, [])]
+    nprops = sum(len(props) for matches, props in groups)
+    nmatches = sum(len(matches) for matches, props in groups)
+
+    # build the grammars outside of the measurement
+    parse_hwdb.property_grammar()
+    parse_hwdb.property_grammars()
+
+    yield result('check_properties_reference' + label,
+                 timed(repeat, lambda: parse_hwdb.check_properties(groups, [], reference=True)),
+                 nprops, 'properties')
+    yield result('check_properties' + label,
+                 timed(repeat, lambda: parse_hwdb.check_properties(groups, [])),
+                 nprops, 'properties')
+    yield result('check_match_uniqueness' + label,
+                 timed(repeat, lambda: parse_hwdb.check_match_uniqueness(groups, [])),
+                 nmatches, 'matches')
+
+def bench_validate(files, repeat, jobs):
+    def validate():
+        results = parse_hwdb.validate_all(files, jobs)
+        parse_hwdb.check_global_matches(results, [])
+    yield result('validate_all', timed(repeat, validate), count_lines(files), 'lines')
+
+def bench_ids(files, repeat):
+    yield result('validate_ids',
+                 timed(repeat, lambda: [parse_hwdb.validate_ids(f) for f in files]),
+                 count_lines(files), 'lines')
+
+def sample_modaliases(files, count):
+    "Turn match patterns from files into modalias strings which they match"
+    modaliases = []
+    for fname in files:
+        errors = []
+        if parse_hwdb.is_id_database(fname):
+            groups = parse_hwdb.iter_groups(fname, errors, parse_hwdb.ID_MATCH_RE, parse_hwdb.ID_PROPERTY_RE)
+        else:
+            groups = parse_hwdb.iter_groups(fname, errors)
+        for matches, props in groups:
+            modaliases += (re.sub(r'\[!?(.)[^]]*\]', r'\1', match).replace('*', '').replace('?', '0')
+                           for match in matches)
+    return random.Random(0).sample(modaliases, min(count, len(modaliases)))
+
+def bench_trie(files, count):
+    start = time.perf_counter()
+    parse_hwdb.build_trie(files, [])
+    elapsed = time.perf_counter() - start
+
+    # build again to measure the size, tracemalloc skews the timing
+    tracemalloc.start()
+    root = parse_hwdb.build_trie(files, [])
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    nodes, children, values = parse_hwdb.trie_stats(root)
+    res = result('build_trie', elapsed, nodes, 'nodes')
+    res['bytes'] = size
+    yield res
+
+    modaliases = sample_modaliases(files, count)
+    start = time.perf_counter()
+    for modalias in modaliases:
+        parse_hwdb.lookup(root, modalias)
+    yield result('lookup', time.perf_counter() - start, len(modaliases), 'lookups')
+
+BENCHMARKS = ('parse', 'checks', 'validate', 'ids', 'trie')
+
+def print_text(res):
+    line = '{name}: {seconds:.4f} s, {items} {unit}'.format(**res)
+    if res['per_item_us'] is not None:
+        line += ' ({:.2f} µs each)'.format(res['per_item_us'])
+    if 'bytes' in res:
+        line += ', {:.1f} MB'.format(res['bytes'] / 1e6)
+    print(line, flush=True)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--groups', type=int, default=500,
+                        help='match groups per synthetic file')
+    parser.add_argument('--files', type=int, default=8,
+                        help='number of synthetic files')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='worker processes for the validate benchmark')
+    parser.add_argument('--file', default=os.path.join(HWDB_DIR, '60-keyboard.hwdb'),
+                        help='real hwdb file for the checks benchmark')
+    parser.add_argument('--lookups', type=int, default=10000,
+                        help='number of modaliases for the lookup benchmark')
+    parser.add_argument('--json', action='store_true',
+                        help='print the results as JSON')
+    parser.add_argument('benchmarks', nargs='*', metavar='BENCHMARK',
+                        help='benchmarks to run, out of {} (default: all)'.format(', '.join(BENCHMARKS)))
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: {}'.format(name))
+    args.benchmarks = args.benchmarks or BENCHMARKS
+    return args
+
+def run(args, tmpdir):
+    files = [os.path.join(tmpdir, '70-synthetic-{}.hwdb'.format(i)) for i in range(args.files)]
+    for i, fname in enumerate(files):
+        generate_hwdb(fname, args.groups, args.seed + i)
+
+    if 'parse' in args.benchmarks:
+        yield from bench_parse(files, args.repeat)
+    if 'checks' in args.benchmarks:
+        yield from bench_checks(files, args.repeat)
+        yield from bench_checks([args.file], args.repeat,
+                                '[{}]'.format(os.path.basename(args.file)))
+    if 'validate' in args.benchmarks:
+        yield from bench_validate(files, args.repeat, args.jobs)
+    if 'ids' in args.benchmarks:
+        yield from bench_ids(sorted(glob.glob(HWDB_DIR + '/20-*.hwdb')), args.repeat)
+    if 'trie' in args.benchmarks:
+        yield from bench_trie(sorted(glob.glob(HWDB_DIR + '/[267]0-*.hwdb')), args.lookups)
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for res in run(args, tmpdir):
+            results.append(res)
+            if not args.json:
+                print_text(res)
+
+    if args.json:
+        json.dump({'groups': args.groups,
+                   'files': args.files,
+                   'seed': args.seed,
+                   'results': results},
+                  sys.stdout, indent=2)
+        print()
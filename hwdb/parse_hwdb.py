@@ -26,10 +26,19 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 
+import argparse
+import collections
+import fnmatch
+import functools
 import glob
+import hashlib
+import itertools
+import multiprocessing
+import re
 import string
 import sys
 import os
+import pickle
 
 try:
     from pyparsing import (Word, White, Literal, ParserElement, Regex,
@@ -46,7 +55,6 @@ try:
     from evdev.ecodes import ecodes
 except ImportError:
     ecodes = None
-    print('WARNING: evdev is not available')
 
 try:
     from functools import lru_cache
@@ -88,12 +96,17 @@ def hwdb_grammar():
              (EMPTYLINE ^ stringEnd()).suppress())
     commentgroup = OneOrMore(COMMENTLINE).suppress() - EMPTYLINE.suppress()
 
-    grammar = OneOrMore(group('GROUPS*') ^ commentgroup) + stringEnd()
+    grammar = OneOrMore(Group(group)('GROUPS*') ^ commentgroup) + stringEnd()
 
     return grammar
 
 @lru_cache()
-def property_grammar():
+def property_grammars():
+    """Return a grammar for each property.
+
+    Returns a dict mapping property names to grammars, and a list of
+    (prefix, grammar) pairs for properties with variable names.
+    """
     ParserElement.setDefaultWhitespaceChars(' ')
 
     dpi_setting = (Optional('*')('DEFAULT') + INTEGER('DPI') + Suppress('@') + INTEGER('HZ'))('SETTINGS*')
@@ -118,115 +131,771 @@ def property_grammar():
              ('KEYBOARD_LED_CAPSLOCK', Literal('0')),
              ('ACCEL_MOUNT_MATRIX', mount_matrix),
             )
-    fixed_props = [Literal(name)('NAME') - Suppress('=') - val('VALUE')
-                   for name, val in props]
-    kbd_props = [Regex(r'KEYBOARD_KEY_[0-9a-f]+')('NAME')
+    fixed_props = {name: Literal(name)('NAME') - Suppress('=') - val('VALUE') + EOL
+                   for name, val in props}
+    kbd_props = (Regex(r'KEYBOARD_KEY_[0-9a-f]+')('NAME')
                  - Suppress('=') -
                  ('!' ^ (Optional('!') - Word(alphanums + '_')))('VALUE')
-                ]
-    abs_props = [Regex(r'EVDEV_ABS_[0-9a-f]{2}')('NAME')
+                 + EOL)
+    abs_props = (Regex(r'EVDEV_ABS_[0-9a-f]{2}')('NAME')
                  - Suppress('=') -
                  Word(nums + ':')('VALUE')
-                ]
+                 + EOL)
 
-    grammar = Or(fixed_props + kbd_props + abs_props) + EOL
+    return fixed_props, [('KEYBOARD_KEY_', kbd_props), ('EVDEV_ABS_', abs_props)]
 
-    return grammar
+@lru_cache()
+def property_grammar():
+    "A single grammar which tries all property grammars in turn"
+    fixed_props, prefixed_props = property_grammars()
+    return Or(list(fixed_props.values()) + [grammar for prefix, grammar in prefixed_props])
+
+def property_grammar_for(name):
+    "Return the grammar for property name, or None if it is not known"
+    fixed_props, prefixed_props = property_grammars()
+    if name in fixed_props:
+        return fixed_props[name]
+    for prefix, grammar in prefixed_props:
+        if name.startswith(prefix):
+            return grammar
+    return None
 
-ERROR = False
-def error(fmt, *args, **kwargs):
-    global ERROR
-    ERROR = True
-    print(fmt.format(*args, **kwargs))
+# The same line syntax as hwdb_grammar(), as plain regular expressions.
+# Used by the line-oriented parser below, which avoids pyparsing's
+# backtracking and is an order of magnitude faster.
+PRINTABLES = ''.join(c for c in string.printable if c not in string.whitespace)
+MATCH_RE = re.compile('(?:{})[{}]+$'.format(
+    '|'.join('{}:(?:{}):'.format(category, '|'.join(re.escape(c) for c in conn))
+             for category, conn in TYPES.items()),
+    re.escape(PRINTABLES + ' ' + '®')))
+PROPERTY_RE = re.compile(r'[A-Z][A-Za-z0-9_]*=[A-Za-z0-9_=:@*.!\-;, "]+(?:#.*)?$')
+
+# The ID databases (20-*.hwdb) are generated from usb.ids, pci.ids and
+# similar sources. They use different match prefixes, and only contain
+# ID_*_FROM_DATABASE properties with free-form values.
+ID_TYPES = ('acpi', 'bluetooth', 'OUI', 'pci', 'sdio', 'usb')
+ID_MATCH_RE = re.compile('(?:{}):[{}]+$'.format('|'.join(ID_TYPES), re.escape(PRINTABLES + ' ')))
+ID_PROPERTY_RE = re.compile(r'ID_[A-Z_]+_FROM_DATABASE=.')
+
+FileResult = collections.namedtuple('FileResult', 'fname groups matches properties entries errors')
+
+def error(errors, fmt, *args, **kwargs):
+    errors.append(fmt.format(*args, **kwargs))
 
 def convert_properties(group):
     matches = [m[0] for m in group.MATCHES]
     props = [p[0] for p in group.PROPERTIES]
     return matches, props
 
-def parse(fname):
+def parse_reference(fname, errors):
     grammar = hwdb_grammar()
     try:
         with open(fname, 'r', encoding='UTF-8') as f:
             parsed = grammar.parseFile(f)
     except ParseBaseException as e:
-        error('Cannot parse {}: {}', fname, e)
+        error(errors, 'Cannot parse {}: {}', fname, e)
         return []
     return [convert_properties(g) for g in parsed.GROUPS]
 
-def check_match_uniqueness(groups):
-    matches = sum((group[0] for group in groups), [])
-    matches.sort()
-    prev = None
-    for match in matches:
-        if match == prev:
-            error('Match {!r} is duplicated', match)
-        prev = match
+def normalize_reference(groups):
+    "Strip trailing whitespace from groups, like iter_groups() does"
+    return [([m.rstrip('\r\n\t ') for m in matches],
+             [p.rstrip('\r\n\t ') for p in props])
+            for matches, props in groups]
+
+def iter_groups(fname, errors, match_re=MATCH_RE, property_re=PROPERTY_RE):
+    """Parse fname and yield a (matches, props) tuple for each group.
+
+    This is a line-oriented state machine which accepts the same syntax
+    as hwdb_grammar(), with these intentional differences, all of which
+    follow systemd-hwdb:
 
-def check_one_default(prop, settings):
+    - runs of empty lines between blocks are accepted,
+    - trailing whitespace is stripped from match and property lines,
+      where the grammar keeps it,
+    - properties indented with a tab are rejected, where the grammar
+      accepts them.
+
+    Like the grammar, properties may be indented by more than one space,
+    and indented comments are allowed both between and inside of groups.
+
+    Each group is yielded as soon as it is complete, so the file is never
+    kept in memory as a whole. On a syntax error the error is added to
+    errors and iteration stops.
+
+    match_re and property_re are the expressions used to check match and
+    property lines.
+    """
+    matches, props, in_props = [], [], False
+    with open(fname, 'r', encoding='UTF-8') as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.rstrip('\r\n\t ')
+            if not line:
+                if matches and not in_props:
+                    error(errors, 'Cannot parse {}: line {}: expected property after match', fname, lineno)
+                    return
+                if matches:
+                    yield matches, props
+                matches, props, in_props = [], [], False
+            elif line[0] == '#':
+                if in_props:
+                    error(errors, 'Cannot parse {}: line {}: comment inside properties', fname, lineno)
+                    return
+            elif line[0] == ' ':
+                line = line.lstrip(' ')
+                if line[0] == '#':
+                    continue
+                if not matches:
+                    error(errors, 'Cannot parse {}: line {}: property without match', fname, lineno)
+                    return
+                in_props = True
+                if not property_re.match(line):
+                    error(errors, 'Cannot parse {}: line {}: invalid property {!r}', fname, lineno, line)
+                    return
+                props.append(line)
+            elif line[0] == '\t':
+                error(errors, 'Cannot parse {}: line {}: indented with a tab', fname, lineno)
+                return
+            elif in_props:
+                error(errors, 'Cannot parse {}: line {}: missing empty line before match', fname, lineno)
+                return
+            elif match_re.match(line):
+                matches.append(line)
+            else:
+                error(errors, 'Cannot parse {}: line {}: invalid match {!r}', fname, lineno, line)
+                return
+    if matches and not in_props:
+        error(errors, 'Cannot parse {}: unexpected end of file after match', fname)
+        return
+    if matches:
+        yield matches, props
+
+def parse(fname, errors):
+    "Parse fname into a list of (matches, props) groups, or [] on error"
+    nerrors = len(errors)
+    groups = list(iter_groups(fname, errors))
+    return groups if len(errors) == nerrors else []
+
+def check_match_uniqueness(groups, errors, seen=None):
+    "Check that no match appears twice, seen is the set of earlier matches"
+    if seen is None:
+        seen = set()
+    for matches, props in groups:
+        for match in matches:
+            if match in seen:
+                error(errors, 'Match {!r} is duplicated', match)
+            seen.add(match)
+
+def check_one_default(prop, settings, errors):
     defaults = [s for s in settings if s.DEFAULT]
     if len(defaults) > 1:
-        error('More than one star entry: {!r}', prop)
+        error(errors, 'More than one star entry: {!r}', prop)
 
-def check_one_mount_matrix(prop, value):
+def check_one_mount_matrix(prop, value, errors):
     numbers = [s for s in value if s not in {';', ','}]
     if len(numbers) != 9:
-        error('Wrong accel matrix: {!r}', prop)
+        error(errors, 'Wrong accel matrix: {!r}', prop)
     try:
         numbers = [abs(float(number)) for number in numbers]
     except ValueError:
-        error('Wrong accel matrix: {!r}', prop)
+        error(errors, 'Wrong accel matrix: {!r}', prop)
     bad_x, bad_y, bad_z = max(numbers[0:3]) == 0, max(numbers[3:6]) == 0, max(numbers[6:9]) == 0
     if bad_x or bad_y or bad_z:
-        error('Mount matrix is all zero in {} row: {!r}',
-              'x' if bad_x else ('y' if bad_y else 'z'),
-              prop)
-
-def check_one_keycode(prop, value):
-    if value != '!' and ecodes is not None:
-        key = 'KEY_' + value.upper()
-        if key not in ecodes:
-            key = value.upper()
-            if key not in ecodes:
-                error('Keycode {} unknown', key)
-
-def check_properties(groups):
-    grammar = property_grammar()
+        error(errors, 'Mount matrix is all zero in {} row: {!r}',
+                      'x' if bad_x else ('y' if bad_y else 'z'),
+                      prop)
+
+def keycode_names():
+    """Return the names of all KEY_* and BTN_* codes
+
+    The names are taken from evdev if it is available, and otherwise from
+    keyboard-keys.txt, a snapshot of linux/input-event-codes.h created with
+    src/udev/generate-keyboard-keys-list.sh. Returns None if neither is
+    available.
+    """
+    if ecodes is not None:
+        return [name for name in ecodes if name.startswith(('KEY_', 'BTN_'))]
+    try:
+        with open(os.path.join(os.path.dirname(__file__), 'keyboard-keys.txt')) as f:
+            return [line.strip() for line in f if line.strip()]
+    except FileNotFoundError:
+        return None
+
+@lru_cache()
+def keycodes():
+    "Return a set of all valid key code spellings in upper case, or None"
+    names = keycode_names()
+    if names is None:
+        print('WARNING: neither evdev nor keyboard-keys.txt is available', file=sys.stderr)
+        return None
+    return frozenset(itertools.chain(names,
+                                     (name[4:] for name in names if name.startswith('KEY_'))))
+
+def check_keycodes(keys, errors):
+    "Check a batch of key code names from KEYBOARD_KEY_* properties"
+    known = keycodes()
+    if known is None:
+        return
+    for key in keys:
+        if key.upper() not in known:
+            error(errors, 'Keycode {} unknown', key.upper())
+
+def check_properties(groups, errors, reference=False):
     for matches, props in groups:
-        prop_names = set()
-        for prop in props:
-            # print('--', prop)
-            prop = prop.partition('#')[0].rstrip()
-            try:
-                parsed = grammar.parseString(prop)
-            except ParseBaseException as e:
-                error('Failed to parse: {!r}', prop)
+        check_group_properties(props, errors, reference)
+
+def check_group_properties(props, errors, reference=False):
+    prop_names = set()
+    keys = []
+    for prop in props:
+        # print('--', prop)
+        prop = prop.partition('#')[0].rstrip()
+        if reference:
+            grammar = property_grammar()
+        else:
+            grammar = property_grammar_for(prop.partition('=')[0].rstrip())
+        if grammar is None:
+            error(errors, 'Unknown property: {!r}', prop)
+            continue
+        try:
+            parsed = grammar.parseString(prop)
+        except ParseBaseException as e:
+            error(errors, 'Failed to parse: {!r}', prop)
+            continue
+        # print('{!r}'.format(parsed))
+        if parsed.NAME in prop_names:
+            error(errors, 'Property {} is duplicated', parsed.NAME)
+        prop_names.add(parsed.NAME)
+        if parsed.NAME == 'MOUSE_DPI':
+            check_one_default(prop, parsed.VALUE.SETTINGS, errors)
+        elif parsed.NAME == 'ACCEL_MOUNT_MATRIX':
+            check_one_mount_matrix(prop, parsed.VALUE, errors)
+        elif parsed.NAME.startswith('KEYBOARD_KEY_'):
+            # the value is '!', or an optional '!' followed by the key name
+            if parsed.VALUE[-1] != '!':
+                keys.append(parsed.VALUE[-1])
+    check_keycodes(keys, errors)
+
+GLOB_STAR = object()
+GLOB_ANY = object()
+
+def glob_tokens(pattern):
+    """Split an fnmatch pattern into tokens.
+
+    Literal characters are returned as themselves, '*' and '?' as GLOB_STAR
+    and GLOB_ANY, and bracket expressions as (negated, frozenset(chars)).
+    """
+    tokens = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        end = pattern.find(']', i + 2) if c == '[' else -1
+        if c == '*':
+            if not tokens or tokens[-1] is not GLOB_STAR:
+                tokens.append(GLOB_STAR)
+        elif c == '?':
+            tokens.append(GLOB_ANY)
+        elif end > 0:
+            body = pattern[i+1:end]
+            negated = body[0] == '!'
+            if negated:
+                body = body[1:]
+            chars = set()
+            j = 0
+            while j < len(body):
+                if j + 2 < len(body) and body[j+1] == '-':
+                    chars.update(chr(k) for k in range(ord(body[j]), ord(body[j+2]) + 1))
+                    j += 3
+                else:
+                    chars.add(body[j])
+                    j += 1
+            tokens.append((negated, frozenset(chars)))
+            i = end
+        else:
+            tokens.append(c)
+        i += 1
+    return tokens
+
+def glob_token_covers(a, b):
+    "Does token a match every character matched by token b?"
+    if b is GLOB_STAR:
+        return False
+    if a is GLOB_ANY:
+        return True
+    if isinstance(a, str):
+        return a == b
+    negated, chars = a
+    if b is GLOB_ANY:
+        return negated and not chars
+    if isinstance(b, str):
+        return (b in chars) != negated
+    b_negated, b_chars = b
+    if not negated:
+        return not b_negated and b_chars <= chars
+    return chars <= b_chars if b_negated else not (chars & b_chars)
+
+def glob_covers(a, b):
+    """Does pattern a match every string matched by pattern b?
+
+    a and b are lists of tokens as returned by glob_tokens(). This is
+    conservative: it only returns True if the covering can be proven
+    token by token, which is the case for all patterns used in hwdb.
+    """
+    # reach[j] is True if a[:i] can cover b[:j]
+    reach = [True] + [False] * len(b)
+    for token in a:
+        if token is GLOB_STAR:
+            for j in range(1, len(b) + 1):
+                reach[j] = reach[j] or reach[j-1]
+        else:
+            reach = [False] + [reach[j] and glob_token_covers(token, b[j])
+                               for j in range(len(b))]
+        if not any(reach):
+            return False
+    return reach[-1]
+
+def literal_prefix(tokens):
+    return ''.join(itertools.takewhile(lambda t: isinstance(t, str), tokens))
+
+def literal_segments(tokens):
+    return [''.join(group)
+            for literal, group in itertools.groupby(tokens, lambda t: isinstance(t, str))
+            if literal]
+
+def segments_in_order(segments, text):
+    pos = 0
+    for segment in segments:
+        pos = text.find(segment, pos)
+        if pos < 0:
+            return False
+        pos += len(segment)
+    return True
+
+KEY_LENGTH = 8
+
+def key_grams(segment):
+    "The substrings of segment which are used as keys, see index_candidates()"
+    n = min(KEY_LENGTH, len(segment))
+    return {segment[i:i+n] for i in range(len(segment) - n + 1)}
+
+def probe_grams(segments):
+    "All substrings of segments which can be keys, see candidates()"
+    return {segment[i:j]
+            for segment in segments
+            for i in range(len(segment))
+            for j in range(i + 1, min(i + KEY_LENGTH, len(segment)) + 1)}
+
+def index_candidates(entries):
+    """Index the entries of one trie node by a literal substring.
+
+    A pattern a can only cover a pattern b if every literal segment of a
+    matches literal characters of b, i.e. it is a substring of a literal
+    segment of b, and so is every substring of it. Each pattern is keyed
+    on the substring of up to KEY_LENGTH characters from its segments
+    after the literal prefix which is rarest among the entries of the
+    node. Patterns without such segments can cover anything below the
+    node and are returned in a separate list.
+
+    Returns (unkeyed entries, {key: [entries]}).
+    """
+    counts = collections.Counter()
+    grams = []
+    for entry in entries:
+        tokens, segments = entry[3], entry[4]
+        if tokens and isinstance(tokens[0], str):
+            segments = segments[1:]
+        entry_grams = set().union(*(key_grams(segment) for segment in segments))
+        counts.update(entry_grams)
+        grams.append(entry_grams)
+
+    unkeyed, keyed = [], {}
+    for entry, entry_grams in zip(entries, grams):
+        if entry_grams:
+            key = min(sorted(entry_grams), key=counts.__getitem__)
+            keyed.setdefault(key, []).append(entry)
+        else:
+            unkeyed.append(entry)
+    return unkeyed, keyed
+
+def candidates(index, probes):
+    "Yield the entries of index which may cover a pattern with substrings probes"
+    unkeyed, keyed = index
+    yield from unkeyed
+    if len(keyed) < len(probes):
+        for key, entries in keyed.items():
+            if key in probes:
+                yield from entries
+    else:
+        for key in probes:
+            yield from keyed.get(key, ())
+
+def check_global_matches(results, errors):
+    """Check match patterns from all files against each other.
+
+    Every match is put in a trie keyed on the literal prefix of the
+    pattern (i.e. 'category:conn:' followed by anything before the first
+    wildcard). A pattern can only cover another one if its literal prefix
+    is a prefix of the literal prefix of the other one, so the candidates
+    are found by walking down the trie. Many patterns have a wildcard
+    right after 'dmi:' or similar and end up in the same node, so the
+    entries of every node are indexed once more by a literal substring
+    from later in the pattern, see index_candidates(). Finally the literal
+    segments of a pattern must all appear in order in any pattern it
+    covers, which is a cheap check before calling glob_covers().
+
+    Exact duplicates between files are reported, and so are patterns fully
+    covered by a pattern from a different file which sets some of the same
+    properties, because then the final value depends on the order in which
+    the files are read. Inside of a single file a generic match followed by
+    more specific overrides is a common pattern and is not reported.
+    """
+    trie = {}
+    seen = {}
+    entries = []
+    for result in results:
+        for match, names in result.entries:
+            if match in seen:
+                if seen[match] != result.fname:
+                    error(errors, 'Match {!r} in {} is duplicated in {}',
+                          match, seen[match], result.fname)
                 continue
-            # print('{!r}'.format(parsed))
-            if parsed.NAME in prop_names:
-                error('Property {} is duplicated', parsed.NAME)
-            prop_names.add(parsed.NAME)
-            if parsed.NAME == 'MOUSE_DPI':
-                check_one_default(prop, parsed.VALUE.SETTINGS)
-            elif parsed.NAME == 'ACCEL_MOUNT_MATRIX':
-                check_one_mount_matrix(prop, parsed.VALUE)
-            elif parsed.NAME.startswith('KEYBOARD_KEY_'):
-                check_one_keycode(prop, parsed.VALUE)
-
-def print_summary(fname, groups):
+            seen[match] = result.fname
+            tokens = glob_tokens(match)
+            entry = (match, result.fname, names, tokens, literal_segments(tokens))
+            entries.append(entry)
+            node = trie
+            for c in literal_prefix(tokens):
+                node = node.setdefault(c, {})
+            node.setdefault('', []).append(entry)
+
+    nodes = [trie]
+    while nodes:
+        node = nodes.pop()
+        for c, child in node.items():
+            if c == '':
+                node[''] = index_candidates(child)
+            else:
+                nodes.append(child)
+
+    for match, fname, names, tokens, segments in entries:
+        probes = probe_grams(segments)
+        node = trie
+        for c in itertools.chain(literal_prefix(tokens), [None]):
+            if '' in node:
+                for other, other_fname, other_names, other_tokens, other_segments in candidates(node[''], probes):
+                    if other_fname == fname:
+                        continue
+                    common = names & other_names
+                    if (common and
+                        segments_in_order(other_segments, match) and
+                        glob_covers(other_tokens, tokens)):
+                        error(errors, 'Match {!r} ({}) is shadowed by {!r} ({}) for {}',
+                              match, fname, other, other_fname, ', '.join(sorted(common)))
+            node = node.get(c)
+            if node is None:
+                break
+
+def validate(fname, reference=False):
+    "Parse and check fname, return a FileResult"
+    if is_id_database(fname):
+        return validate_ids(fname)
+
+    errors = []
+    if reference:
+        groups = parse(fname, errors)
+        # after a parse error there is nothing to compare, and the
+        # grammar may accept what iter_groups() rejects on purpose
+        if not errors and normalize_reference(parse_reference(fname, errors)) != groups:
+            error(errors, '{}: parse results differ from the reference grammar', fname)
+    else:
+        groups = iter_groups(fname, errors)
+
+    ngroups = nmatches = nprops = 0
+    entries = []
+    seen = set()
+    for group in groups:
+        matches, props = group
+        ngroups += 1
+        nmatches += len(matches)
+        nprops += len(props)
+        check_match_uniqueness([group], errors, seen)
+        check_group_properties(props, errors)
+        names = frozenset(prop.partition('=')[0] for prop in props)
+        entries.extend((match, names) for match in matches)
+
+    return FileResult(fname, ngroups, nmatches, nprops, entries, errors)
+
+def is_id_database(fname):
+    return os.path.basename(fname).startswith('20-')
+
+def validate_ids(fname):
+    """Check an ID database, return a FileResult
+
+    The ID databases are hundreds of thousands of lines long, so they are
+    checked in a single streaming pass. The only state kept across groups
+    is the set of hashes of the matches seen so far, which is used to
+    detect duplicates. Matches are not added to the cross-file index.
+    """
+    errors = []
+    ngroups = nmatches = nprops = 0
+    seen = set()
+    for matches, props in iter_groups(fname, errors, ID_MATCH_RE, ID_PROPERTY_RE):
+        ngroups += 1
+        nmatches += len(matches)
+        nprops += len(props)
+        for match in matches:
+            h = hash(match)
+            if h in seen:
+                error(errors, 'Match {!r} is duplicated', match)
+            seen.add(h)
+        if len(props) > 1:
+            names = [prop.partition('=')[0] for prop in props]
+            for name in set(names):
+                if names.count(name) > 1:
+                    error(errors, 'Property {} is duplicated', name)
+
+    return FileResult(fname, ngroups, nmatches, nprops, [], errors)
+
+class TrieNode:
+    """A node of the hwdb trie, see src/hwdb/hwdb.c
+
+    Like in hwdb.bin, each node has a (possibly empty) prefix string, a
+    map from the next character to child nodes, and the properties of
+    the match which ends at this node. Properties are stored as
+    {key: (value, order)}, where order is (file index, sequence number)
+    and replaces the file priority and line number of hwdb.bin.
+    """
+    __slots__ = ('prefix', 'children', 'values')
+
+    def __init__(self, prefix=''):
+        self.prefix = prefix
+        self.children = {}
+        self.values = {}
+
+def trie_insert(root, search, key, value, order):
+    node = root
+    i = 0
+    while True:
+        prefix = node.prefix
+        p = 0
+        while p < len(prefix) and i + p < len(search) and prefix[p] == search[i + p]:
+            p += 1
+        if p < len(prefix):
+            # split the node at the first mismatch
+            child = TrieNode(prefix[p + 1:])
+            child.children, child.values = node.children, node.values
+            node.prefix, node.children, node.values = prefix[:p], {prefix[p]: child}, {}
+        i += p
+
+        if i == len(search):
+            node.values[key] = (value, order)
+            return
+
+        child = node.children.get(search[i])
+        if child is None:
+            child = node.children[search[i]] = TrieNode(search[i + 1:])
+            child.values[key] = (value, order)
+            return
+        node = child
+        i += 1
+
+def build_trie(files, errors):
+    """Build a trie from files, like systemd-hwdb update
+
+    Files are imported in order, so on conflicts the later file wins,
+    as if the files had increasing priority.
+    """
+    root = TrieNode()
+    seq = 0
+    for index, fname in enumerate(files):
+        if is_id_database(fname):
+            groups = iter_groups(fname, errors, ID_MATCH_RE, ID_PROPERTY_RE)
+        else:
+            groups = iter_groups(fname, errors)
+        for matches, props in groups:
+            for prop in props:
+                # systemd-hwdb strips everything after a '#' as a comment
+                key, _, value = prop.partition('#')[0].rstrip().partition('=')
+                seq += 1
+                for match in matches:
+                    trie_insert(root, match, key, value, (index, seq))
+    return root
+
+def _trie_add_values(props, node):
+    for key, (value, order) in node.values.items():
+        old = props.get(key)
+        if old is None or old[1] < order:
+            props[key] = (value, order)
+
+def _trie_fnmatch(props, node, pattern, search):
+    pattern += node.prefix
+    for c, child in sorted(node.children.items()):
+        _trie_fnmatch(props, child, pattern + c, search)
+    if node.values and fnmatch.fnmatchcase(search, pattern):
+        _trie_add_values(props, node)
+
+def lookup(root, modalias):
+    """Return the properties for modalias as a dict, like sd_hwdb_get()
+
+    This follows trie_search_f() in sd-hwdb.c: literal characters are
+    followed down the trie, and each subtree starting with a glob
+    character is matched against the rest of modalias with fnmatch.
+    """
+    props = {}
+    node = root
+    i = 0
+    while node is not None:
+        for p, c in enumerate(node.prefix):
+            if c in '*?[':
+                child = TrieNode(node.prefix[p:])
+                child.children, child.values = node.children, node.values
+                _trie_fnmatch(props, child, '', modalias[i + p:])
+                return {key: value for key, (value, order) in props.items()}
+            if i + p >= len(modalias) or c != modalias[i + p]:
+                return {key: value for key, (value, order) in props.items()}
+        i += len(node.prefix)
+
+        for c in '*?[':
+            child = node.children.get(c)
+            if child is not None:
+                _trie_fnmatch(props, child, c, modalias[i:])
+
+        if i == len(modalias):
+            _trie_add_values(props, node)
+            break
+        node = node.children.get(modalias[i])
+        i += 1
+    return {key: value for key, (value, order) in props.items()}
+
+def trie_stats(root):
+    "Return the number of nodes, children and values in the trie"
+    nodes = children = values = 0
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        nodes += 1
+        children += len(node.children)
+        values += len(node.values)
+        stack.extend(node.children.values())
+    return nodes, children, values
+
+def print_result(result):
     print('{}: {} match groups, {} matches, {} properties'
-          .format(fname,
-                  len(groups),
-                  sum(len(matches) for matches, props in groups),
-                  sum(len(props) for matches, props in groups)))
+          .format(result.fname, result.groups, result.matches, result.properties))
+    for message in result.errors:
+        print(message)
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--reference', action='store_true',
+                        help='also parse with the pyparsing grammar and compare the results')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N',
+                        help='check files in N worker processes (0 means one per CPU)')
+    parser.add_argument('--ids', action='store_true',
+                        help='also check the 20-*.hwdb ID databases by default')
+    parser.add_argument('--cache', metavar='FILE',
+                        help='reuse results for unchanged files from FILE')
+    parser.add_argument('--lookup', metavar='FILE',
+                        help='print the properties for each modalias listed in FILE instead of checking files')
+    parser.add_argument('files', nargs='*')
+    args = parser.parse_args()
+    if not args.files:
+        pattern = '/[267]0-*.hwdb' if args.ids else '/[67]0-*.hwdb'
+        args.files = sorted(glob.glob(os.path.dirname(sys.argv[0]) + pattern))
+    return args
+
+def file_digest(fname):
+    with open(fname, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def cache_version(reference):
+    "Cached results are only valid for the same checker and options"
+    with open(__file__, 'rb') as f:
+        h = hashlib.sha256(f.read())
+    h.update(repr((reference, sorted(keycodes() or ()))).encode())
+    return h.hexdigest()
+
+def load_cache(path, version):
+    "Return {fname: (digest, FileResult)} from path, or {} if unusable"
+    try:
+        with open(path, 'rb') as f:
+            cache = pickle.load(f)
+    except FileNotFoundError:
+        return {}
+    except Exception as e:
+        print('Ignoring cache {}: {}'.format(path, e))
+        return {}
+    if cache.get('version') != version:
+        return {}
+    return {fname: (digest, FileResult(*result))
+            for fname, (digest, result) in cache['files'].items()}
+
+def save_cache(path, version, files):
+    # store plain tuples, so that the cache can be read no matter
+    # whether this file is run as a script or imported as a module
+    files = {fname: (digest, tuple(result))
+             for fname, (digest, result) in files.items()}
+    tmp = path + '.tmp'
+    with open(tmp, 'wb') as f:
+        pickle.dump({'version': version, 'files': files}, f)
+    os.replace(tmp, path)
+
+def validate_all(files, jobs=1, reference=False, cache=None):
+    """Validate files, in parallel if jobs != 1, and return results in order
+
+    If cache is given, results are loaded from and stored in that file,
+    and only files whose contents changed since the last run are checked.
+    """
+    if cache:
+        version = cache_version(reference)
+        cached = load_cache(cache, version)
+        digests = {fname: file_digest(fname) for fname in files}
+        todo = [fname for fname in files
+                if fname not in cached or cached[fname][0] != digests[fname]]
+    else:
+        cached = {}
+        todo = files
+
+    func = functools.partial(validate, reference=reference)
+    if jobs == 1 or len(todo) <= 1:
+        results = [func(fname) for fname in todo]
+    else:
+        with multiprocessing.Pool(jobs or None) as pool:
+            results = pool.map(func, todo, chunksize=1)
+
+    if cache:
+        cached.update((result.fname, (digests[result.fname], result)) for result in results)
+        save_cache(cache, version, cached)
+        return [cached[fname][1] for fname in files]
+    return results
+
+def print_lookups(files, modaliases):
+    errors = []
+    root = build_trie(files, errors)
+    for message in errors:
+        print(message, file=sys.stderr)
+    for modalias in modaliases:
+        print(modalias)
+        for key, value in sorted(lookup(root, modalias).items()):
+            print(' {}={}'.format(key, value))
+        print()
+    return bool(errors)
 
 if __name__ == '__main__':
-    args = sys.argv[1:] or glob.glob(os.path.dirname(sys.argv[0]) + '/[67]0-*.hwdb')
+    args = parse_args()
+
+    if args.lookup:
+        with (sys.stdin if args.lookup == '-' else open(args.lookup)) as f:
+            modaliases = [line.strip() for line in f if line.strip()]
+        sys.exit(print_lookups(args.files, modaliases))
+
+    results = validate_all(args.files, args.jobs, args.reference, args.cache)
+    for result in results:
+        print_result(result)
 
-    for fname in args:
-        groups = parse(fname)
-        print_summary(fname, groups)
-        check_match_uniqueness(groups)
-        check_properties(groups)
+    errors = []
+    check_global_matches(results, errors)
+    for message in errors:
+        print(message)
 
-    sys.exit(ERROR)
+    sys.exit(bool(errors) or any(result.errors for result in results))
@@ -1,75 +1,645 @@
 #!/usr/bin/env python3
 import sys
 import argparse
+import base64
+import contextlib
+import functools
+import hmac
+import http.client
+import io
+import itertools
+import json
+import mmap
+import multiprocessing
+import os
+import random
+import string
+import struct
+import time
+import urllib.parse
+
+# Workload profiles: the fields of every entry besides the cursor, the
+# timestamps and the trusted fields of the template below, and how their
+# values are chosen. Each field maps to one of
+#
+#   {'value': v}                              always v
+#   {'values': [v, ...], 'weights': [w, ...]} one of the values, weights are optional
+#   {'zipf': s, 'cardinality': n, 'format': 'unit-{}.service'}
+#                                             one of n values, the k-th with
+#                                             probability proportional to 1/k^s
+#   {'length': l, 'payload': p}               generated content of length l
+#
+# where l is a number, {'uniform': [min, max]} or {'lognormal': [mu, sigma]},
+# and p is 'text' (compressible, made of words), 'base64' (random, printable),
+# 'binary' (random raw bytes, written as a binary field), 'repr' (repr() of
+# random bytes) or 'counter' (the entry number, zero-padded).
+#
+# {'reuse': r} can be added to any of these to repeat one of the last
+# 'reuse-window' (1000) values of the field with probability r.
+#
+# A JSON file with an object of this form can be given instead of a name.
+# The default profile is built from --data-size, --data-type and --binary.
+PROFILES = {
+    'default': None,
+    'syslog': {
+        'PRIORITY': {'values': [2, 3, 4, 5, 6, 7],
+                     'weights': [1, 5, 10, 10, 60, 14]},
+        'SYSLOG_FACILITY': {'values': [0, 1, 3, 4, 10],
+                            'weights': [5, 20, 60, 10, 5]},
+        'SYSLOG_IDENTIFIER': {'zipf': 1.2, 'cardinality': 300, 'format': 'daemon{}'},
+        '_SYSTEMD_UNIT': {'zipf': 1.2, 'cardinality': 300, 'format': 'unit{}.service'},
+        '_PID': {'zipf': 1.0, 'cardinality': 5000, 'format': '{}'},
+        'MESSAGE': {'length': {'lognormal': [4.5, 0.8]}, 'payload': 'text',
+                    'reuse': 0.3},
+    },
+}
+PROFILES['syslog-incompressible'] = dict(
+    PROFILES['syslog'],
+    MESSAGE={'length': {'lognormal': [4.5, 0.8]}, 'payload': 'base64'})
+
+def default_profile(options):
+    payload = 'binary' if options.binary else 'repr'
+    return {
+        'PRIORITY': {'value': 3},
+        'SYSLOG_FACILITY': {'value': 6},
+        'SYSLOG_IDENTIFIER': {'value': '/USR/SBIN/CRON'},
+        'MESSAGE': {'length': 2000, 'payload': payload},
+        'SYSLOG_PID': {'value': 25721},
+        '_PID': {'value': 25721},
+        'DATA': {'length': options.data_size,
+                 'payload': payload if options.data_type == 'random' else 'counter'},
+    }
+
+def load_profile(options):
+    if options.profile in PROFILES:
+        return PROFILES[options.profile] or default_profile(options)
+    try:
+        with open(options.profile) as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        raise SystemExit('Cannot load profile {}: {}'.format(options.profile, e))
+
+def rates(arg):
+    return [float(rate) for rate in arg.split(',')]
 
 PARSER = argparse.ArgumentParser()
-PARSER.add_argument('n', type=int)
+PARSER.add_argument('n', type=int, nargs='?',
+                    help='number of entries (with --replay: at most, default all)')
 PARSER.add_argument('--dots', action='store_true')
-PARSER.add_argument('--data-size', type=int, default=4000)
-PARSER.add_argument('--data-type', choices={'random', 'simple'})
-OPTIONS = PARSER.parse_args()
-
-template = """\
-__CURSOR=s=6863c726210b4560b7048889d8ada5c5;i=3e931;b=f446871715504074bf7049ef0718fa93;m={m:x};t=4fd05c
-__REALTIME_TIMESTAMP={realtime_ts}
-__MONOTONIC_TIMESTAMP={monotonic_ts}
+PARSER.add_argument('--profile', default='default',
+                    help='workload profile, one of {} or a JSON file '
+                         '(see PROFILES)'.format(', '.join(PROFILES)))
+PARSER.add_argument('--data-size', type=int, default=4000,
+                    help='size of DATA= in the default profile')
+PARSER.add_argument('--data-type', choices={'random', 'simple'},
+                    help='content of DATA= in the default profile')
+PARSER.add_argument('--binary', action='store_true',
+                    help='write random MESSAGE= and DATA= of the default profile '
+                         'as binary fields with the raw bytes instead of their repr()')
+PARSER.add_argument('--buffer-size', type=int, default=1 << 20,
+                    help='bytes collected before each write to stdout')
+PARSER.add_argument('--seed', type=int,
+                    help='seed of the random data, for reproducible output')
+PARSER.add_argument('--workers', type=int, default=1,
+                    help='generate in this many processes (0: one per CPU)')
+PARSER.add_argument('--shard-output', metavar='PATTERN',
+                    help='write the part of each worker to its own file, '
+                         'PATTERN.format(shard), instead of merging them to stdout')
+PARSER.add_argument('--url',
+                    help='stream to systemd-journal-remote --listen-http at URL, '
+                         'e.g. http://localhost:19532, instead of writing to stdout')
+PARSER.add_argument('--request-entries', type=int, default=1000,
+                    help='entries uploaded in each HTTP request')
+PARSER.add_argument('--rate', type=rates,
+                    help='entries per second to send, a comma-separated list '
+                         'sweeps the rates, sending n entries at each')
+PARSER.add_argument('--byte-rate', type=rates,
+                    help='bytes per second to send, like --rate')
+PARSER.add_argument('--replay', metavar='FILE',
+                    help='replay the entries of FILE, as written by journalctl -o export, '
+                         'instead of generating them')
+PARSER.add_argument('--speed', type=float,
+                    help='with --replay, emit entries at their original pace sped up '
+                         'by this factor, and scale their timestamps to match')
+PARSER.add_argument('--anonymize', metavar='FIELD,...', type=lambda arg: arg.split(','),
+                    default=[],
+                    help='with --replay, replace the values of these fields by '
+                         'random data of the same length, keyed by their value')
+
+# Entries are generated in blocks, each with its own PRNG seeded from
+# --seed and the block number, so that the output does not depend on how
+# the blocks are spread over workers.
+BLOCK_SIZE = 256
+
+# The fixed part of every entry, in the order of the export format. The
+# %b are the fields of the profile.
+template = b"""\
+__CURSOR=s=6863c726210b4560b7048889d8ada5c5;i=%x;b=f446871715504074bf7049ef0718fa93;m=%x;t=4fd05c
+__REALTIME_TIMESTAMP=%d
+__MONOTONIC_TIMESTAMP=%d
 _BOOT_ID=f446871715504074bf7049ef0718fa93
 _TRANSPORT=syslog
-PRIORITY={priority}
-SYSLOG_FACILITY={facility}
-SYSLOG_IDENTIFIER=/USR/SBIN/CRON
-MESSAGE={message}
 _UID=0
 _GID=0
 _MACHINE_ID=69121ca41d12c1b69a7960174c27b618
 _HOSTNAME=hostname
-SYSLOG_PID=25721
-_PID=25721
-_SOURCE_REALTIME_TIMESTAMP={source_realtime_ts}
-DATA={data}
+_SOURCE_REALTIME_TIMESTAMP=%d
+%b
 """
 
-m = 0x198603b12d7
-realtime_ts = 1404101101501873
-monotonic_ts = 1753961140951
-source_realtime_ts = 1404101101483516
-priority = 3
-facility = 6
+def field(name, value, binary=False):
+    """Return one field in the export format.
 
-src = open('/dev/urandom', 'rb')
+    Binary fields are the name, a newline, the size of the value as a
+    little-endian 64-bit integer and the value, so the value may contain
+    newlines and any other bytes.
+    """
+    if binary:
+        return b'%b\n%b%b\n' % (name, struct.pack('<Q', len(value)), value)
+    return b'%b=%b\n' % (name, value)
 
-bytes = 0
-counter = 0
+def randbytes(rng, n):
+    "Return n random bytes from rng, like Random.randbytes() of newer Pythons."
+    return rng.getrandbits(8 * n).to_bytes(n, 'little') if n else b''
 
-for i in range(OPTIONS.n):
-    message = repr(src.read(2000))
-    if OPTIONS.data_type == 'random':
-        data = repr(src.read(OPTIONS.data_size))
-    else:
+class Writer:
+    "Collect entries in one preallocated buffer and write it out when full."
+
+    def __init__(self, out, size):
+        self.out = out
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.pos = 0
+        self.written = 0
+
+    def write(self, data):
+        end = self.pos + len(data)
+        if end > len(self.buffer):
+            self.flush()
+            if len(data) > len(self.buffer):
+                self.out.write(data)
+                self.written += len(data)
+                return
+            end = len(data)
+        self.view[self.pos:end] = data
+        self.pos = end
+
+    def flush(self):
+        self.out.write(self.view[:self.pos])
+        self.written += self.pos
+        self.pos = 0
+        self.out.flush()
+
+def _words():
+    # a fixed vocabulary with Zipfian word frequencies, for 'text' payloads
+    rng = random.Random(0)
+    words = [''.join(rng.choices(string.ascii_lowercase, k=rng.randint(2, 10))).encode()
+             for _ in range(2000)]
+    return words, list(itertools.accumulate(1 / k for k in range(1, len(words) + 1)))
+
+WORDS = None
+
+class Field:
+    "One field of a profile, see PROFILES."
+
+    def __init__(self, name, spec):
+        global WORDS
+
+        self.name = name.encode()
+        self.binary = spec.get('payload') == 'binary'
+        self.reuse = spec.get('reuse', 0)
+        self.window = spec.get('reuse-window', 1000)
+        self.history = []
+
+        if 'value' in spec:
+            value = str(spec['value']).encode()
+            self.sample = lambda rng, i: value
+        elif 'values' in spec:
+            values = [str(v).encode() for v in spec['values']]
+            weights = spec.get('weights')
+            self.sample = lambda rng, i: rng.choices(values, weights)[0]
+        elif 'zipf' in spec:
+            n = spec['cardinality']
+            fmt = spec.get('format', '{}')
+            values = [fmt.format(k).encode() for k in range(1, n + 1)]
+            cum_weights = list(itertools.accumulate(1 / k ** spec['zipf']
+                                                    for k in range(1, n + 1)))
+            self.sample = lambda rng, i: rng.choices(values, cum_weights=cum_weights)[0]
+        elif 'length' in spec:
+            self.length = self._length(spec['length'])
+            self.sample = getattr(self, '_' + spec['payload'])
+            if spec['payload'] == 'text' and WORDS is None:
+                WORDS = _words()
+        else:
+            raise SystemExit('Field {} needs one of value, values, zipf or length'.format(name))
+
+    @staticmethod
+    def _length(length):
+        if isinstance(length, int):
+            return lambda rng: length
+        if 'uniform' in length:
+            return lambda rng: rng.randint(*length['uniform'])
+        if 'lognormal' in length:
+            return lambda rng: max(1, int(rng.lognormvariate(*length['lognormal'])))
+        raise SystemExit('Unknown length {}'.format(length))
+
+    def _text(self, rng, i):
+        n = self.length(rng)
+        words, cum_weights = WORDS
+        return b' '.join(rng.choices(words, cum_weights=cum_weights, k=n // 4 + 1))[:n]
+
+    def _base64(self, rng, i):
+        n = self.length(rng)
+        return base64.b64encode(randbytes(rng, n * 3 // 4 + 3))[:n]
+
+    def _binary(self, rng, i):
+        return randbytes(rng, self.length(rng))
+
+    def _repr(self, rng, i):
+        return repr(randbytes(rng, self.length(rng))).encode()
+
+    def _counter(self, rng, i):
         # keep the pattern non-repeating so we get a different blob every time
-        data = '{:0{}}'.format(counter, OPTIONS.data_size)
-        counter += 1
-
-    entry = template.format(m=m,
-                            realtime_ts=realtime_ts,
-                            monotonic_ts=monotonic_ts,
-                            source_realtime_ts=source_realtime_ts,
-                            priority=priority,
-                            facility=facility,
-                            message=message,
-                            data=data)
-    m += 1
-    realtime_ts += 1
-    monotonic_ts += 1
-    source_realtime_ts += 1
-
-    bytes += len(entry)
-
-    print(entry)
+        return b'%0*d' % (self.length(rng), i)
 
-    if OPTIONS.dots:
-        print('.', file=sys.stderr, end='', flush=True)
+    def reset(self):
+        self.history.clear()
+
+    def encode(self, rng, i):
+        if self.history and self.reuse and rng.random() < self.reuse:
+            value = rng.choice(self.history)
+        else:
+            value = self.sample(rng, i)
+            if self.reuse:
+                if len(self.history) < self.window:
+                    self.history.append(value)
+                else:
+                    self.history[rng.randrange(self.window)] = value
+        return field(self.name, value, self.binary)
+
+def entries(options, start, stop):
+    """Yield entries start to stop-1.
+
+    Cursor, seqnum and timestamps are derived from the entry number, so
+    separately generated ranges fit together into one stream.
+    """
+    seqnum = 0x3e931 + start
+    m = 0x198603b12d7 + start
+    realtime_ts = 1404101101501873 + start
+    monotonic_ts = 1753961140951 + start
+    source_realtime_ts = 1404101101483516 + start
+    fields = [Field(name, spec) for name, spec in load_profile(options).items()]
+
+    for i in range(start, stop):
+        if i == start or i % BLOCK_SIZE == 0:
+            rng = random.Random(options.seed << 32 | i // BLOCK_SIZE)
+            for f in fields:
+                f.reset()
+
+        yield template % (seqnum, m, realtime_ts, monotonic_ts, source_realtime_ts,
+                          b''.join([f.encode(rng, i) for f in fields]))
+        seqnum += 1
+        m += 1
+        realtime_ts += 1
+        monotonic_ts += 1
+        source_realtime_ts += 1
+
+def generate(options, writer, start, stop):
+    "Write entries start to stop-1 to writer."
+    for entry in entries(options, start, stop):
+        writer.write(entry)
+        if options.dots:
+            print('.', file=sys.stderr, end='', flush=True)
+    writer.flush()
+
+class Replay:
+    """The entries of a journal export file, made to look new.
+
+    The file is mapped into memory and parsed one entry at a time, so it
+    can be much larger than RAM. Entries are passed on as they are,
+    except for these fields:
+
+    - __REALTIME_TIMESTAMP starts now and keeps the original spacing,
+      divided by --speed, but never goes backwards.
+    - _BOOT_ID is replaced by a new random ID per original boot, and
+      __MONOTONIC_TIMESTAMP starts over for every boot in the same way.
+    - __CURSOR, __SEQNUM and __SEQNUM_ID describe a new, gapless sequence.
+    - _SOURCE_REALTIME_TIMESTAMP and _SOURCE_MONOTONIC_TIMESTAMP are moved
+      by the same amount as the timestamps of their entry.
+    - The fields of --anonymize get random bytes (hex digits for text
+      fields) of the original length, seeded by an HMAC of their value.
+      Equal values stay equal.
+
+    With --speed, due is set to the number of seconds after the start at
+    which the last entry should be emitted.
+    """
+
+    MONOTONIC_START = 1000000
+    REWRITE = {b'__CURSOR', b'__REALTIME_TIMESTAMP', b'__MONOTONIC_TIMESTAMP',
+               b'__SEQNUM', b'__SEQNUM_ID', b'_BOOT_ID',
+               b'_SOURCE_REALTIME_TIMESTAMP', b'_SOURCE_MONOTONIC_TIMESTAMP'}
 
-if OPTIONS.dots:
-    print(file=sys.stderr)
-print('Wrote {} bytes'.format(bytes), file=sys.stderr)
+    def __init__(self, options):
+        with open(options.replay, 'rb') as f:
+            # journalctl writes an empty file when nothing matches, which
+            # cannot be mapped
+            if os.fstat(f.fileno()).st_size:
+                self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            else:
+                self.map = b''
+        if hasattr(self.map, 'madvise'):
+            self.map.madvise(mmap.MADV_SEQUENTIAL)
+        self.speed = options.speed or 1
+        self.paced = options.speed is not None
+        self.anonymize = {name.encode() for name in options.anonymize}
+        self.rng = random.Random(options.seed)
+        self.key = randbytes(self.rng, 32)
+        self.due = 0
+
+    def _entries(self):
+        "Yield the fields of every entry, as [raw bytes or (name, value, binary), ...]."
+        m = self.map
+        pos, end = 0, len(m)
+        fields = []
+        while pos < end:
+            nl = m.find(b'\n', pos)
+            if nl < 0:
+                nl = end
+            if nl == pos:
+                # an empty line ends the entry
+                pos += 1
+                if fields:
+                    yield fields
+                    fields = []
+                continue
+            eq = m.find(b'=', pos, nl)
+            if eq >= 0:
+                name, start, stop, next = m[pos:eq], eq + 1, nl, nl + 1
+            else:
+                # binary field: name, newline, le64 size, data, newline
+                name = m[pos:nl]
+                size, = struct.unpack_from('<Q', m, nl + 1)
+                start = nl + 9
+                stop, next = start + size, start + size + 1
+            if name in self.REWRITE or name in self.anonymize:
+                fields.append((name, m[start:stop], eq < 0))
+            else:
+                fields.append(m[pos:next])
+            pos = next
+        if fields:
+            yield fields
+
+    def _anonymized(self, name, value, binary):
+        # the HMAC seeds a keystream as long as the value, so the result
+        # is as incompressible as random data
+        digest = hmac.new(self.key, name + b'\0' + value, 'sha256').digest()
+        stream = random.Random(digest)
+        if binary:
+            return randbytes(stream, len(value))
+        return randbytes(stream, (len(value) + 1) // 2).hex().encode()[:len(value)]
+
+    def __iter__(self):
+        rng = self.rng
+        seqnum_id = randbytes(rng, 16).hex().encode()
+        realtime_start = int(time.time() * 1000000)
+        realtime = first_realtime = None
+        boots = {}
+
+        for seqnum, fields in enumerate(self._entries(), 1):
+            values = {f[0]: f[1] for f in fields if isinstance(f, tuple)}
+
+            original_realtime = int(values.get(b'__REALTIME_TIMESTAMP', first_realtime or 0))
+            if first_realtime is None:
+                first_realtime = original_realtime
+            realtime = max(realtime_start + int((original_realtime - first_realtime) / self.speed),
+                           realtime + 1 if realtime else 0)
+            if self.paced:
+                self.due = (realtime - realtime_start) / 1000000
+
+            original_boot = values.get(b'_BOOT_ID', b'')
+            if original_boot not in boots:
+                boots[original_boot] = [randbytes(rng, 16).hex().encode(), None, 0]
+            boot = boots[original_boot]
+            original_monotonic = int(values.get(b'__MONOTONIC_TIMESTAMP', boot[1] or 0))
+            if boot[1] is None:
+                boot[1] = original_monotonic
+            monotonic = boot[2] = max(self.MONOTONIC_START +
+                                      int((original_monotonic - boot[1]) / self.speed),
+                                      boot[2] + 1)
+
+            new = {
+                b'__CURSOR': b's=%s;i=%x;b=%s;m=%x;t=%x' % (seqnum_id, seqnum, boot[0],
+                                                             monotonic, realtime),
+                b'__REALTIME_TIMESTAMP': b'%d' % realtime,
+                b'__MONOTONIC_TIMESTAMP': b'%d' % monotonic,
+                b'__SEQNUM': b'%d' % seqnum,
+                b'__SEQNUM_ID': seqnum_id,
+                b'_BOOT_ID': boot[0],
+            }
+            for name, shift in ((b'_SOURCE_REALTIME_TIMESTAMP', realtime - original_realtime),
+                                (b'_SOURCE_MONOTONIC_TIMESTAMP', monotonic - original_monotonic)):
+                if name in values:
+                    new[name] = b'%d' % max(0, int(values[name]) + shift)
+
+            out = []
+            for f in fields:
+                if not isinstance(f, tuple):
+                    out.append(f)
+                    continue
+                name, value, binary = f
+                if name in self.anonymize:
+                    value = self._anonymized(name, value, binary)
+                else:
+                    value = new.get(name, value)
+                out.append(field(name, value, binary))
+            out.append(b'\n')
+            yield b''.join(out)
+
+def write_replay(options, writer, replay):
+    "Write the entries of replay to writer, at their pace if --speed is given."
+    start = time.monotonic()
+    for entry in itertools.islice(replay, options.n):
+        if replay.paced:
+            pace(writer, start, replay.due)
+        writer.write(entry)
+        if options.dots:
+            print('.', file=sys.stderr, end='', flush=True)
+    writer.flush()
+
+def _block_range(options, first, last):
+    return first * BLOCK_SIZE, min(last * BLOCK_SIZE, options.n)
+
+def _generate_block(options, block):
+    out = io.BytesIO()
+    writer = Writer(out, options.buffer_size)
+    generate(options, writer, *_block_range(options, block, block + 1))
+    return out.getvalue()
+
+def _generate_shard(options, shards, shard):
+    blocks = -(-options.n // BLOCK_SIZE)
+    first, last = blocks * shard // shards, blocks * (shard + 1) // shards
+    with open(options.shard_output.format(shard), 'wb') as f:
+        writer = Writer(f, options.buffer_size)
+        generate(options, writer, *_block_range(options, first, last))
+    return writer.written
+
+def generate_parallel(options, writer):
+    """Generate with options.workers processes.
+
+    Every worker either writes a contiguous range of blocks to its own
+    file, or blocks are generated in parallel and written to writer in
+    order. Returns the number of bytes written.
+    """
+    workers = options.workers or os.cpu_count()
+    with multiprocessing.Pool(workers) as pool:
+        if options.shard_output:
+            return sum(pool.map(functools.partial(_generate_shard, options, workers),
+                                range(workers)))
+        blocks = -(-options.n // BLOCK_SIZE)
+        for data in pool.imap(functools.partial(_generate_block, options), range(blocks)):
+            writer.write(data)
+        writer.flush()
+        return writer.written
+
+class ChunkedUpload:
+    "Send what is written as the chunks of an HTTP request body."
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def write(self, data):
+        # an empty chunk would end the body
+        if data:
+            self.conn.send(b'%x\r\n' % len(data))
+            self.conn.send(data)
+            self.conn.send(b'\r\n')
+
+    def flush(self):
+        pass
+
+    def finish(self):
+        self.conn.send(b'0\r\n\r\n')
+
+def pace(writer, start, due):
+    "Send what writer holds and sleep, if we are ahead of due seconds since start."
+    wait = start + due - time.monotonic()
+    if wait > 0.001:
+        writer.flush()
+        time.sleep(wait)
+
+def percentile(values, p):
+    "Return the p-th percentile of sorted values, by nearest rank."
+    return values[max(0, -(-len(values) * p // 100) - 1)]
+
+def stream(options, conn, path, entries, rate, byte_rate, replay=None):
+    """Upload entries in requests of options.request_entries entries.
+
+    If rate or byte_rate is set, sending is paced to stay below it. With
+    a paced replay, entries are not sent before replay.due.
+    Returns (entries, bytes, seconds, [request latency, ...]), where the
+    latency of a request is the time from the end of its body to the
+    response, i.e. how long journal-remote needed to catch up.
+    """
+    count = sent = 0
+    latencies = []
+    start = time.monotonic()
+    entries = iter(entries)
+    # entries are pulled one at a time, so that replay.due belongs to the
+    # entry about to be written
+    entry = next(entries, None)
+    while entry is not None:
+        conn.putrequest('POST', path)
+        conn.putheader('Content-Type', 'application/vnd.fdo.journal')
+        conn.putheader('Transfer-Encoding', 'chunked')
+        conn.endheaders()
+        upload = ChunkedUpload(conn)
+        writer = Writer(upload, options.buffer_size)
+        for _ in range(options.request_entries):
+            pace(writer, start,
+                 max(count / rate if rate else 0,
+                     (sent + writer.written + writer.pos) / byte_rate if byte_rate else 0,
+                     replay.due if replay else 0))
+            writer.write(entry)
+            count += 1
+            entry = next(entries, None)
+            if entry is None:
+                break
+        writer.flush()
+        upload.finish()
+        sent += writer.written
+
+        t = time.monotonic()
+        response = conn.getresponse()
+        body = response.read()
+        latencies.append(time.monotonic() - t)
+        if response.status != http.client.ACCEPTED:
+            raise SystemExit('Upload failed: {} {}'.format(response.status,
+                                                           body.decode(errors='replace').strip()))
+
+    return count, sent, time.monotonic() - start, latencies
+
+def stream_sweep(options, replay=None):
+    """Stream n entries to options.url at every rate of --rate or
+    --byte-rate, and report throughput and latency of each to stderr.
+    Entries come from replay if given. Returns the number of bytes sent."""
+    url = urllib.parse.urlsplit(options.url)
+    if url.scheme == 'https':
+        conn = http.client.HTTPSConnection(url.hostname, url.port or 19532)
+    else:
+        conn = http.client.HTTPConnection(url.hostname, url.port or 19532)
+    path = url.path if url.path not in ('', '/') else '/upload'
+
+    if options.rate and options.byte_rate:
+        raise SystemExit('--rate and --byte-rate cannot be combined')
+    steps = options.rate or options.byte_rate or [None]
+    if replay:
+        if replay.paced and steps != [None]:
+            raise SystemExit('--speed cannot be combined with --rate or --byte-rate')
+        stream_entries = iter(replay)
+    else:
+        stream_entries = entries(options, 0, options.n * len(steps))
+
+    total = 0
+    with contextlib.closing(conn):
+        for target in steps:
+            rate, byte_rate = (None, target) if options.byte_rate else (target, None)
+            count, sent, seconds, latencies = stream(
+                options, conn, path, itertools.islice(stream_entries, options.n),
+                rate, byte_rate, replay)
+            total += sent
+            report = '{}: {} entries, {} bytes in {:.2f}s: {:.0f} entries/s, {:.2f} MB/s'.format(
+                'target {:g}{}'.format(target, '/s' if options.rate else ' B/s')
+                if target else 'unlimited',
+                count, sent, seconds, count / (seconds or 1), sent / (seconds or 1) / 1e6)
+            if latencies:
+                latencies.sort()
+                report += ', latency p50 {:.1f}ms p90 {:.1f}ms p99 {:.1f}ms max {:.1f}ms'.format(
+                    *(percentile(latencies, p) * 1000 for p in (50, 90, 99, 100)))
+            print(report, file=sys.stderr)
+    return total
+
+if __name__ == '__main__':
+    OPTIONS = PARSER.parse_args()
+    if OPTIONS.seed is None:
+        OPTIONS.seed = random.SystemRandom().getrandbits(32)
+        print('Seed {}'.format(OPTIONS.seed), file=sys.stderr)
+    if OPTIONS.replay:
+        if OPTIONS.workers != 1 or OPTIONS.shard_output:
+            PARSER.error('--replay cannot be combined with --workers or --shard-output')
+    elif OPTIONS.n is None:
+        PARSER.error('the number of entries is required')
+    writer = Writer(sys.stdout.buffer, OPTIONS.buffer_size)
+    if OPTIONS.url:
+        written = stream_sweep(OPTIONS, Replay(OPTIONS) if OPTIONS.replay else None)
+    elif OPTIONS.replay:
+        write_replay(OPTIONS, writer, Replay(OPTIONS))
+        written = writer.written
+    elif OPTIONS.workers == 1 and not OPTIONS.shard_output:
+        generate(OPTIONS, writer, 0, OPTIONS.n)
+        written = writer.written
+    else:
+        written = generate_parallel(OPTIONS, writer)
+
+    if OPTIONS.dots:
+        print(file=sys.stderr)
+    print('Wrote {} bytes'.format(written), file=sys.stderr)
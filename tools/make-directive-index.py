@@ -18,11 +18,13 @@
 #  You should have received a copy of the GNU Lesser General Public License
 #  along with systemd; If not, see <http://www.gnu.org/licenses/>.
 
-import sys
+import argparse
 import collections
 import re
-from xml_helper import xml_parse, xml_print, tree
-from copy import deepcopy
+import sys
+from xml_helper import tree
+from man_data import load_pages
+from man_server import forward
 
 TEMPLATE = '''\
 <refentry id="systemd.directives" conditional="HAVE_PYTHON">
@@ -179,91 +181,39 @@ This index contains {count} entries in {sections} sections,
 referring to {pages} individual manual pages.
 '''
 
-def _extract_directives(directive_groups, formatting, page):
-    t = xml_parse(page)
-    section = t.find('./refmeta/manvolnum').text
-    pagename = t.find('./refmeta/refentrytitle').text
-
-    storopt = directive_groups['options']
-    for variablelist in t.iterfind('.//variablelist'):
-        klass = variablelist.attrib.get('class')
-        storvar = directive_groups[klass or 'miscellaneous']
-        # <option>s go in OPTIONS, unless class is specified
-        for xpath, stor in (('./varlistentry/term/varname', storvar),
-                            ('./varlistentry/term/option',
-                             storvar if klass else storopt)):
-            for name in variablelist.iterfind(xpath):
-                text = re.sub(r'([= ]).*', r'\1', name.text).rstrip()
-                stor[text].append((pagename, section))
-                if text not in formatting:
-                    # use element as formatted display
-                    if name.text[-1] in '= ':
-                        name.clear()
-                    else:
-                        name.tail = ''
-                    name.text = text
-                    formatting[text] = name
-
-    storfile = directive_groups['filenames']
-    for xpath, absolute_only in (('.//refsynopsisdiv//filename', False),
-                                 ('.//refsynopsisdiv//command', False),
-                                 ('.//filename', True)):
-        for name in t.iterfind(xpath):
-            if absolute_only and not (name.text and name.text.startswith('/')):
-                continue
-            if name.attrib.get('noindex'):
-                continue
-            name.tail = ''
-            if name.text:
-                if name.text.endswith('*'):
-                    name.text = name.text[:-1]
-                if not name.text.startswith('.'):
-                    text = name.text.partition(' ')[0]
-                    if text != name.text:
-                        name.clear()
-                        name.text = text
-                    if text.endswith('/'):
-                        text = text[:-1]
-                    storfile[text].append((pagename, section))
-                    if text not in formatting:
-                        # use element as formatted display
-                        formatting[text] = name
-            else:
-                text = ' '.join(name.itertext())
-                storfile[text].append((pagename, section))
-                formatting[text] = name
-
-    storfile = directive_groups['constants']
-    for name in t.iterfind('.//constant'):
-        if name.attrib.get('noindex'):
-            continue
-        name.tail = ''
-        if name.text.startswith('('): # a cast, strip it
-            name.text = name.text.partition(' ')[2]
-        storfile[name.text].append((pagename, section))
-        formatting[name.text] = name
-
-def _make_section(template, name, directives, formatting):
-    varlist = template.find(".//*[@id='{}']".format(name))
+def _write_section(xf, directives, formatting):
     for varname, manpages in sorted(directives.items()):
-        entry = tree.SubElement(varlist, 'varlistentry')
-        term = tree.SubElement(entry, 'term')
-        display = deepcopy(formatting[varname])
-        term.append(display)
-
-        para = tree.SubElement(tree.SubElement(entry, 'listitem'), 'para')
-
-        b = None
-        for manpage, manvolume in sorted(set(manpages)):
-            if b is not None:
-                b.tail = ', '
-            b = tree.SubElement(para, 'citerefentry')
-            c = tree.SubElement(b, 'refentrytitle')
-            c.text = manpage
-            c.attrib['target'] = varname
-            d = tree.SubElement(b, 'manvolnum')
-            d.text = manvolume
-        entry.tail = '\n\n'
+        with xf.element('varlistentry'):
+            with xf.element('term'):
+                xf.write(tree.fromstring(formatting[varname]), with_tail=False)
+            with xf.element('listitem'), xf.element('para'):
+                sep = None
+                for manpage, manvolume in sorted(set(manpages)):
+                    if sep:
+                        xf.write(sep)
+                    with xf.element('citerefentry'):
+                        with xf.element('refentrytitle', target=varname):
+                            xf.write(manpage)
+                        with xf.element('manvolnum'):
+                            xf.write(manvolume)
+                    sep = ', '
+        xf.write('\n\n')
+
+def _write_element(xf, element, directive_groups, formatting):
+    # copy the template, streaming the variablelists as they are reached
+    directives = directive_groups.get(element.get('id'))
+    if directives or element.find('.//variablelist') is not None:
+        with xf.element(element.tag, element.attrib):
+            if element.text:
+                xf.write(element.text)
+            if directives:
+                _write_section(xf, directives, formatting)
+            for child in element:
+                _write_element(xf, child, directive_groups, formatting)
+    else:
+        xf.write(element, with_tail=False)
+    if element.tail:
+        xf.write(element.tail)
 
 def _make_colophon(template, groups):
     count = 0
@@ -278,37 +228,119 @@ def _make_colophon(template, groups):
                                 sections=len(groups),
                                 pages=len(pages))
 
-def _make_page(template, directive_groups, formatting):
-    """Create an XML tree from directive_groups.
+def _write_page(f, template, directive_groups, formatting):
+    """Write the index page for directive_groups to f.
 
     directive_groups = {
        'class': {'variable': [('manpage', 'manvolume'), ...],
                  'variable2': ...},
        ...
     }
-    """
-    for name, directives in directive_groups.items():
-        _make_section(template, name, directives, formatting)
+    formatting = {'variable': '<varname>variable</varname>', ...}
 
+    The entries are generated while writing, so the full index never
+    exists as a tree.
+    """
     _make_colophon(template, directive_groups.values())
 
-    return template
+    with tree.xmlfile(f, encoding='utf-8') as xf:
+        _write_element(xf, template, directive_groups, formatting)
+    f.write(b'\n')
+
+def _merge_directives(directive_groups, formatting, page):
+    pagename = page['title']
+    section = page['section']
+
+    for klass, names in page['directives'].items():
+        stor = directive_groups[klass]
+        for text in names:
+            stor[text].append((pagename, section))
+
+    for text, (display, override) in page['formatting'].items():
+        if override or text not in formatting:
+            formatting[text] = display
 
-def make_page(*xml_files):
-    "Extract directives from xml_files and return XML index tree."
+SEARCH_INDEX_HEADER = '# systemd man page search index, version 1'
+
+def _write_search_index(f, directive_groups, pages):
+    """Write an inverted index of directive_groups and pages to f.
+
+    Every line is one of
+
+        d <TAB> directive <TAB> class <TAB> page(section),...
+        w <TAB> word <TAB> page(section),...
+        p <TAB> page(section) <TAB> purpose
+
+    where words are taken from the refpurposes, lowercased. The lines
+    are sorted bytewise, so man-search.py can bisect the file without
+    reading all of it.
+    """
+    def refs(manpages):
+        return ','.join('{}({})'.format(*m) for m in sorted(set(manpages)))
+
+    lines = [SEARCH_INDEX_HEADER]
+    for klass, directives in directive_groups.items():
+        for name, manpages in directives.items():
+            lines.append('\t'.join(('d', name, klass, refs(manpages))))
+
+    words = collections.defaultdict(list)
+    for page in pages:
+        manpage = page['title'], page['section']
+        lines.append('\t'.join(('p', refs([manpage]), page['purpose'])))
+        for word in re.findall(r'\w+', page['purpose'].lower()):
+            words[word].append(manpage)
+    for word, manpages in words.items():
+        lines.append('\t'.join(('w', word, refs(manpages))))
+
+    for line in sorted(line.encode('utf-8') for line in lines):
+        f.write(line + b'\n')
+
+def write_page(f, *xml_files, jobs=1, cache=None, search_index=None):
+    """Extract directives from xml_files and write the index page to f.
+
+    xml_files may also contain data files written by man_data.py.
+    With jobs other than 1, pages are parsed in a process pool, and
+    the per-page records are merged in the order of xml_files. With
+    cache, only pages which changed since the last run are parsed, see
+    man_data.load_pages(). If search_index is given, an inverted index
+    is written there too, see _write_search_index().
+    """
     template = tree.fromstring(TEMPLATE)
     names = [vl.get('id') for vl in template.iterfind('.//variablelist')]
     directive_groups = {name:collections.defaultdict(list)
                         for name in names}
     formatting = {}
-    for page in xml_files:
+    pages = load_pages(xml_files, jobs=jobs, cache=cache)
+    for page in pages:
         try:
-            _extract_directives(directive_groups, formatting, page)
+            _merge_directives(directive_groups, formatting, page)
         except Exception:
-            raise ValueError("failed to process " + page)
-
-    return _make_page(template, directive_groups, formatting)
+            raise ValueError("failed to process " + page['file'])
+
+    _write_page(f, template, directive_groups, formatting)
+
+    if search_index is not None:
+        with open(search_index, 'wb') as g:
+            _write_search_index(g, directive_groups, pages)
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Generate the systemd.directives page')
+    p.add_argument('-j', '--jobs', type=int, default=1,
+                   help='parse pages in this many processes (0: one per CPU)')
+    p.add_argument('--cache', metavar='DIR',
+                   help='keep per-page directives in DIR and only parse changed pages')
+    p.add_argument('--search-index', metavar='FILE',
+                   help='also write an index for man-search.py to FILE')
+    p.add_argument('output')
+    p.add_argument('files', nargs='+')
+    return p.parse_args()
 
 if __name__ == '__main__':
-    with open(sys.argv[1], 'wb') as f:
-        f.write(xml_print(make_page(*sys.argv[2:])))
+    status = forward(__file__)
+    if status is not None:
+        sys.exit(status)
+
+    opts = parse_args()
+    with open(opts.output, 'wb') as f:
+        write_page(f, *opts.files, jobs=opts.jobs, cache=opts.cache,
+                   search_index=opts.search_index)
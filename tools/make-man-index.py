@@ -22,7 +22,9 @@
 import collections
 import sys
 import re
-from xml_helper import xml_parse, xml_print, tree
+from xml_helper import xml_print, tree
+from man_data import load_pages
+from man_server import forward
 
 MDASH = ' — ' if sys.version_info.major >= 3 else ' -- '
 
@@ -70,22 +72,21 @@ COUNTS = '\
 This index contains {count} entries, referring to {pages} individual manual pages.'
 
 
-def check_id(page, t):
-    id = t.getroot().get('id')
-    if not re.search('/' + id + '[.]', page):
-        raise ValueError("id='{}' is not the same as page name '{}'".format(id, page))
+def check_id(page):
+    id = page['id']
+    if not re.search('/' + id + '[.]', page['file']):
+        raise ValueError("id='{}' is not the same as page name '{}'".format(id, page['file']))
 
 def make_index(pages):
     index = collections.defaultdict(list)
     for p in pages:
-        t = xml_parse(p)
-        check_id(p, t)
-        section = t.find('./refmeta/manvolnum').text
-        refname = t.find('./refnamediv/refname').text
-        purpose = ' '.join(t.find('./refnamediv/refpurpose').text.split())
-        for f in t.findall('./refnamediv/refname'):
-            infos = (f.text, section, purpose, refname)
-            index[f.text[0].upper()].append(infos)
+        check_id(p)
+        section = p['section']
+        refname = p['refnames'][0]
+        purpose = p['purpose']
+        for f in p['refnames']:
+            infos = (f, section, purpose, refname)
+            index[f[0].upper()].append(infos)
     return index
 
 def add_letter(template, letter, pages):
@@ -123,7 +124,7 @@ def add_summary(template, indexpages):
 
 def make_page(*xml_files):
     template = tree.fromstring(TEMPLATE)
-    index = make_index(xml_files)
+    index = make_index(load_pages(xml_files, directives=False))
 
     for letter in sorted(index):
         add_letter(template, letter, index[letter])
@@ -133,5 +134,9 @@ def make_page(*xml_files):
     return template
 
 if __name__ == '__main__':
+    status = forward(__file__)
+    if status is not None:
+        sys.exit(status)
+
     with open(sys.argv[1], 'wb') as f:
         f.write(xml_print(make_page(*sys.argv[2:])))
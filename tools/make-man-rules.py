@@ -23,7 +23,8 @@ import collections
 import sys
 import os.path
 import pprint
-from xml_helper import xml_parse
+from man_data import load_pages
+from man_server import forward
 
 def man(page, number):
     return '{}.{}'.format(page, number)
@@ -31,35 +32,34 @@ def man(page, number):
 def xml(file):
     return os.path.basename(file)
 
-def add_rules(rules, name):
-    xml = xml_parse(name)
-    # print('parsing {}'.format(name), file=sys.stderr)
-    if xml.getroot().tag != 'refentry':
+def add_rules(rules, sources, page):
+    if page['tag'] != 'refentry':
         return
-    conditional = xml.getroot().get('conditional') or ''
-    rulegroup = rules[conditional]
-    refmeta = xml.find('./refmeta')
-    title = refmeta.find('./refentrytitle').text
-    number = refmeta.find('./manvolnum').text
-    refnames = xml.findall('./refnamediv/refname')
-    target = man(refnames[0].text, number)
-    if title != refnames[0].text:
-        raise ValueError('refmeta and refnamediv disagree: ' + name)
+    rulegroup = rules[page['conditional']]
+    title = page['title']
+    number = page['section']
+    refnames = page['refnames']
+    target = man(refnames[0], number)
+    if title != refnames[0]:
+        raise ValueError('refmeta and refnamediv disagree: ' + page['file'])
     for refname in refnames:
-        assert all(refname not in group
-                   for group in rules.values()), "duplicate page name"
-        alias = man(refname.text, number)
+        alias = man(refname, number)
+        if alias in sources:
+            raise ValueError('duplicate page name {}: defined in {} and {}'.format(
+                alias, sources[alias], page['file']))
+        sources[alias] = page['file']
         rulegroup[alias] = target
         # print('{} => {} [{}]'.format(alias, target, conditional), file=sys.stderr)
 
-def create_rules(xml_files):
+def create_rules(pages):
     " {conditional => {alias-name => source-name}} "
     rules = collections.defaultdict(dict)
-    for name in xml_files:
+    sources = {} # alias-name => file, over all conditionals
+    for page in pages:
         try:
-            add_rules(rules, name)
+            add_rules(rules, sources, page)
         except Exception:
-            print("Failed to process", name, file=sys.stderr)
+            print("Failed to process", page['file'], file=sys.stderr)
             raise
     return rules
 
@@ -92,10 +92,14 @@ def make_mesonfile(rules, dist_files):
     return '\n'.join((MESON_HEADER, pprint.pformat(lines)[1:-1], MESON_FOOTER))
 
 if __name__ == '__main__':
-    pages = sys.argv[1:]
+    status = forward(__file__)
+    if status is not None:
+        sys.exit(status)
+
+    pages = load_pages(sys.argv[1:], directives=False)
 
     rules = create_rules(pages)
-    dist_files = (xml(file) for file in pages
-                  if not file.endswith(".directives.xml") and
-                     not file.endswith(".index.xml"))
+    dist_files = (xml(page['file']) for page in pages
+                  if not page['file'].endswith(".directives.xml") and
+                     not page['file'].endswith(".index.xml"))
     print(make_mesonfile(rules, dist_files))
@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+#  -*- Mode: python; coding: utf-8; indent-tabs-mode: nil -*- */
+#
+#  This file is part of systemd.
+#
+#  systemd is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+#
+#  systemd is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with systemd; If not, see <http://www.gnu.org/licenses/>.
+
+"""Look up directives and words in the man page search index
+
+    make-directive-index.py --search-index man.idx systemd.directives.xml man/*.xml
+    man-search.py man.idx ProtectSystem=
+    man-search.py man.idx --prefix Protect
+    man-search.py man.idx --words journal file
+    man-search.py man.idx -- --user
+
+The index is mapped into memory and bisected, so a lookup reads only
+the few lines it needs and does not parse any XML.
+"""
+
+import argparse
+import mmap
+import sys
+
+HEADER = b'# systemd man page search index, version 1\n'
+
+class SearchIndex:
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(HEADER)] != HEADER:
+            raise ValueError('{} is not a search index'.format(path))
+
+    def _lines(self, prefix):
+        "Yield the fields of all lines starting with prefix."
+        m = self.map
+        lo, hi = 0, len(m)
+        # find the first line which is not smaller than prefix
+        while lo < hi:
+            mid = (lo + hi) // 2
+            start = m.rfind(b'\n', lo, mid) + 1 or lo
+            end = m.find(b'\n', start)
+            if m[start:end] < prefix:
+                lo = end + 1
+            else:
+                hi = start
+        while lo < len(m):
+            end = m.find(b'\n', lo)
+            line = m[lo:end]
+            if not line.startswith(prefix):
+                break
+            yield line.decode('utf-8').split('\t')[1:]
+            lo = end + 1
+
+    def directive(self, name, prefix=False):
+        "Return [(directive, class, [page, ...]), ...]."
+        key = 'd\t' + name + ('' if prefix else '\t')
+        return [(d, klass, pages.split(','))
+                for d, klass, pages in self._lines(key.encode('utf-8'))]
+
+    def word(self, word):
+        "Return the set of pages with word in their purpose."
+        for _, pages in self._lines('w\t{}\t'.format(word.lower()).encode('utf-8')):
+            return set(pages.split(','))
+        return set()
+
+    def purpose(self, page):
+        for _, purpose in self._lines('p\t{}\t'.format(page).encode('utf-8')):
+            return purpose
+        return None
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Query the man page search index')
+    p.add_argument('index')
+    p.add_argument('-p', '--prefix', action='store_true',
+                   help='match directives starting with the term')
+    p.add_argument('-w', '--words', action='store_true',
+                   help='find pages with all terms in their purpose')
+    p.add_argument('terms', nargs='+')
+    return p.parse_args()
+
+if __name__ == '__main__':
+    opts = parse_args()
+    index = SearchIndex(opts.index)
+    found = False
+
+    if opts.words:
+        pages = set.intersection(*(index.word(term) for term in opts.terms))
+        for page in sorted(pages):
+            print('{} — {}'.format(page, index.purpose(page)))
+            found = True
+    else:
+        for term in opts.terms:
+            for name, klass, pages in index.directive(term, opts.prefix):
+                print('{} ({}): {}'.format(name, klass, ', '.join(pages)))
+                found = True
+
+    sys.exit(0 if found else 1)
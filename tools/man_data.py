@@ -0,0 +1,372 @@
+#!/usr/bin/env python3
+#  -*- Mode: python; coding: utf-8; indent-tabs-mode: nil -*- */
+#
+#  This file is part of systemd.
+#
+#  systemd is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+#
+#  systemd is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with systemd; If not, see <http://www.gnu.org/licenses/>.
+
+"""Extract the data needed by the man page index generators
+
+make-directive-index.py, make-man-index.py and make-man-rules.py all
+need a few bits from each page. This parses every page once and writes
+them to a JSON file which the generators accept in place of the pages:
+
+    man_data.py [-j JOBS] [--cache DIR] man-data.json man/*.xml
+    make-directive-index.py systemd.directives.xml man-data.json
+
+Each page becomes a dictionary:
+
+    {'file': 'man/foo.xml', 'tag': 'refentry', 'id': 'foo',
+     'conditional': '', 'title': 'foo', 'section': '1',
+     'refnames': ['foo', ...], 'purpose': 'Do foo',
+     'directives': {'options': ['--bar', ...], ...},
+     'formatting': {'--bar': ['<option>--bar</option>', False], ...}}
+
+Pages which are not a <refentry> only have the first four keys.
+"""
+
+import argparse
+import hashlib
+import json
+import multiprocessing
+import os
+import re
+import sys
+from copy import deepcopy
+from man_server import forward
+import xml_helper
+from xml_helper import xml_parse, tree, CustomResolver, CUSTOM_ENTITIES, XINCLUDE
+
+def _display(name):
+    # drop namespace declarations inherited from the page
+    name = deepcopy(name)
+    tree.cleanup_namespaces(name)
+    return tree.tostring(name, encoding='unicode', with_tail=False)
+
+def _extract_directives(t):
+    """Return the directives and their formatting for one page.
+
+    directives = {'class': ['variable', ...], ...}
+    formatting = {'variable': ['<varname>variable</varname>', override], ...}
+
+    The index uses the first formatting found for every variable, unless
+    override is set, in which case the last one wins.
+    """
+    directives = {}
+    formatting = {}
+
+    def store(klass, text, name=None, override=False):
+        names = directives.setdefault(klass, [])
+        if text not in names:
+            names.append(text)
+        if name is not None and (override or text not in formatting):
+            formatting[text] = [name, override]
+
+    for variablelist in t.iterfind('.//variablelist'):
+        klass = variablelist.attrib.get('class')
+        # <option>s go in OPTIONS, unless class is specified
+        for xpath, stor in (('./varlistentry/term/varname',
+                             klass or 'miscellaneous'),
+                            ('./varlistentry/term/option',
+                             klass or 'options')):
+            for name in variablelist.iterfind(xpath):
+                text = re.sub(r'([= ]).*', r'\1', name.text).rstrip()
+                if text not in formatting:
+                    # use element as formatted display
+                    if name.text[-1] in '= ':
+                        name.clear()
+                    else:
+                        name.tail = ''
+                    name.text = text
+                    store(stor, text, name)
+                else:
+                    store(stor, text)
+
+    for xpath, absolute_only in (('.//refsynopsisdiv//filename', False),
+                                 ('.//refsynopsisdiv//command', False),
+                                 ('.//filename', True)):
+        for name in t.iterfind(xpath):
+            if absolute_only and not (name.text and name.text.startswith('/')):
+                continue
+            if name.attrib.get('noindex'):
+                continue
+            name.tail = ''
+            if name.text:
+                if name.text.endswith('*'):
+                    name.text = name.text[:-1]
+                if not name.text.startswith('.'):
+                    text = name.text.partition(' ')[0]
+                    if text != name.text:
+                        name.clear()
+                        name.text = text
+                    if text.endswith('/'):
+                        text = text[:-1]
+                    store('filenames', text, name)
+            else:
+                text = ' '.join(name.itertext())
+                store('filenames', text, name, override=True)
+
+    for name in t.iterfind('.//constant'):
+        if name.attrib.get('noindex'):
+            continue
+        name.tail = ''
+        if name.text.startswith('('): # a cast, strip it
+            name.text = name.text.partition(' ')[2]
+        store('constants', name.text, name, override=True)
+
+    # elements are modified in place above, so serialize only at the end
+    for entry in formatting.values():
+        entry[0] = _display(entry[0])
+
+    return directives, formatting
+
+def _extract_header(data, root):
+    data['title'] = root.find('./refmeta/refentrytitle').text
+    data['section'] = root.find('./refmeta/manvolnum').text
+    data['refnames'] = [f.text for f in root.findall('./refnamediv/refname')]
+    data['purpose'] = ' '.join(root.find('./refnamediv/refpurpose').text.split())
+
+def extract_page(page, directives=True):
+    "Parse page and return its dictionary, see above."
+    t = xml_parse(page)
+    root = t.getroot()
+    data = {'file': page,
+            'tag': root.tag,
+            'id': root.get('id'),
+            'conditional': root.get('conditional') or ''}
+    if root.tag != 'refentry':
+        return data
+
+    _extract_header(data, root)
+    if directives:
+        data['directives'], data['formatting'] = _extract_directives(t)
+    return data
+
+def _header_events(page, chunk_size=4096):
+    # feed the page in small pieces, so that reading can stop early
+    parser = tree.XMLPullParser(tag=('refnamediv', XINCLUDE), base_url=page)
+    parser.resolvers.add(CustomResolver())
+    with open(page, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            parser.feed(chunk)
+            yield from parser.read_events()
+    parser.close()
+    yield from parser.read_events()
+
+def extract_header(page):
+    """Return the dictionary of page without the directives.
+
+    This is what make-man-index.py and make-man-rules.py need. The page
+    is parsed incrementally and only up to </refnamediv>, and XIncludes
+    are not processed, unless there is one before that point.
+    """
+    for _, element in _header_events(page):
+        if element.tag == XINCLUDE:
+            return extract_page(page, directives=False)
+        root = element.getroottree().getroot()
+        if element.getparent() is root and root.find('./refmeta') is not None:
+            break
+    else:
+        # no <refnamediv>, so this is not a refentry, or a broken one
+        return extract_page(page, directives=False)
+
+    data = {'file': page,
+            'tag': root.tag,
+            'id': root.get('id'),
+            'conditional': root.get('conditional') or ''}
+    if root.tag != 'refentry':
+        return data
+    _extract_header(data, root)
+    return data
+
+XINCLUDE_RE = re.compile(rb'''<xi:include\s[^>]*?href=["']([^"']+)["']''')
+
+def _stamp(file, data=None):
+    st = os.stat(file)
+    if data is None:
+        with open(file, 'rb') as f:
+            data = f.read()
+    return [st.st_mtime_ns, st.st_size, hashlib.sha256(data).hexdigest()]
+
+def _dependencies(page):
+    """Return {file: stamp} for page, the files it XIncludes and the
+    entity file it uses."""
+    deps = {}
+    todo = [page]
+    while todo:
+        file = os.path.abspath(todo.pop())
+        if file in deps:
+            continue
+        with open(file, 'rb') as f:
+            data = f.read()
+        deps[file] = _stamp(file, data)
+        if b'custom-entities.ent' in data:
+            todo.append(CUSTOM_ENTITIES)
+        for href in XINCLUDE_RE.findall(data):
+            todo.append(os.path.join(os.path.dirname(file), href.decode()))
+    return deps
+
+def _extract_page(args):
+    page, directives, cache = args
+    try:
+        if directives:
+            data = extract_page(page)
+        else:
+            data = extract_header(page)
+        return data, cache and _dependencies(page)
+    except Exception as e:
+        raise ValueError("failed to process {}: {}".format(page, e))
+
+def _cache_version():
+    "Cached data is only valid for the same extraction and parsing code"
+    h = hashlib.sha256()
+    for file in (__file__, xml_helper.__file__):
+        with open(file, 'rb') as f:
+            h.update(f.read())
+    h.update(repr((tree.LXML_VERSION, tree.LIBXML_VERSION)).encode())
+    return h.hexdigest()
+
+# Long-lived callers like man_server.py set this to a dictionary to keep
+# the cache entries in memory, in addition to a cache directory if one
+# is given. {(page, entity file): entry}, see _cache_save().
+memory_cache = None
+
+def _cache_key(page):
+    # the entity file is found relative to the working directory
+    return os.path.abspath(page), os.path.abspath(CUSTOM_ENTITIES)
+
+def _cache_file(cache, page):
+    name = hashlib.sha256('\0'.join(_cache_key(page)).encode()).hexdigest()
+    return os.path.join(cache, name + '.json')
+
+def cache_fresh(deps):
+    "Return whether none of the files in deps changed."
+    for file, (mtime, size, digest) in deps.items():
+        try:
+            st = os.stat(file)
+            if st.st_mtime_ns == mtime and st.st_size == size:
+                continue
+            if _stamp(file)[2] == digest:
+                continue
+        except OSError:
+            pass
+        return False
+    return True
+
+def _cache_load(cache, version, page, directives):
+    entry = None
+    if memory_cache is not None:
+        entry = memory_cache.get(_cache_key(page))
+    if entry is None and cache is not None:
+        try:
+            with open(_cache_file(cache, page), encoding='utf-8') as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if memory_cache is not None:
+            memory_cache[_cache_key(page)] = dict(entry, cwd=os.getcwd())
+    if entry is None or entry['version'] != version:
+        return None
+    data = entry['data']
+    if directives and data['tag'] == 'refentry' and 'directives' not in data:
+        return None
+    if not cache_fresh(entry['deps']):
+        return None
+    return dict(data, file=page)
+
+def _cache_save(cache, version, page, data, deps):
+    entry = {'version': version, 'deps': deps, 'data': data}
+    if memory_cache is not None:
+        memory_cache[_cache_key(page)] = dict(entry, cwd=os.getcwd())
+    if cache is None:
+        return
+    name = _cache_file(cache, page)
+    with open(name + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(entry, f, ensure_ascii=False, separators=(',', ':'))
+    os.replace(name + '.tmp', name)
+
+def load_pages(files, directives=True, jobs=1, cache=None):
+    """Return page dictionaries for files.
+
+    Files ending in .json are read as written by this script, all
+    others are parsed as man pages. With jobs other than 1, pages are
+    parsed in a pool of that many processes (0 means one per CPU).
+    The result is the same either way.
+
+    If cache is a directory, the data of every page is stored there
+    together with the mtime and hash of the page and of the files it
+    includes, and pages which did not change are not parsed again.
+    """
+    caching = cache is not None or memory_cache is not None
+    if cache is not None:
+        os.makedirs(cache, exist_ok=True)
+    if caching:
+        version = _cache_version()
+
+    cached = {}
+    args = []
+    for file in files:
+        if file.endswith('.json') or file in cached:
+            continue
+        data = caching and _cache_load(cache, version, file, directives)
+        if data:
+            cached[file] = data
+        else:
+            args.append((file, directives, caching))
+
+    if jobs != 1 and len(args) > 1:
+        with multiprocessing.Pool(jobs or None) as pool:
+            extracted = pool.map(_extract_page, args)
+    else:
+        extracted = map(_extract_page, args)
+
+    for (file, _, _), (data, deps) in zip(args, extracted):
+        if caching:
+            _cache_save(cache, version, file, data, deps)
+        cached[file] = data
+
+    pages = []
+    for file in files:
+        if file.endswith('.json'):
+            try:
+                with open(file, encoding='utf-8') as f:
+                    pages.extend(json.load(f))
+            except Exception:
+                raise ValueError("failed to process " + file)
+        else:
+            pages.append(cached[file])
+    return pages
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Extract man page data for the index generators')
+    p.add_argument('-j', '--jobs', type=int, default=1,
+                   help='parse pages in this many processes (0: one per CPU)')
+    p.add_argument('--cache', metavar='DIR',
+                   help='keep per-page data in DIR and only parse changed pages')
+    p.add_argument('output')
+    p.add_argument('files', nargs='+')
+    return p.parse_args()
+
+if __name__ == '__main__':
+    status = forward(__file__)
+    if status is not None:
+        sys.exit(status)
+
+    opts = parse_args()
+    # man_server.py runs this file as __main__, but keeps its cache in
+    # the imported module, so go through that
+    import man_data
+    pages = man_data.load_pages(opts.files, jobs=opts.jobs, cache=opts.cache)
+    with open(opts.output, 'w', encoding='utf-8') as f:
+        json.dump(pages, f, ensure_ascii=False, separators=(',', ':'))
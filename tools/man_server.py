@@ -0,0 +1,206 @@
+#!/usr/bin/env python3
+#  -*- Mode: python; coding: utf-8; indent-tabs-mode: nil -*- */
+#
+#  This file is part of systemd.
+#
+#  systemd is free software; you can redistribute it and/or modify it
+#  under the terms of the GNU Lesser General Public License as published by
+#  the Free Software Foundation; either version 2.1 of the License, or
+#  (at your option) any later version.
+#
+#  systemd is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE. See the GNU
+#  Lesser General Public License for more details.
+#
+#  You should have received a copy of the GNU Lesser General Public License
+#  along with systemd; If not, see <http://www.gnu.org/licenses/>.
+
+"""A long-lived helper for the man page generators
+
+During documentation work, man_data.py, make-directive-index.py,
+make-man-index.py and make-man-rules.py are run again and again, and
+each run pays for starting Python, importing lxml and parsing all
+pages. This server keeps the data of the pages in memory, re-reads
+pages in the background when they change, and runs the generators on
+behalf of their command line tools:
+
+    cd build
+    python3 ../tools/man_server.py --socket /tmp/man.sock ../man &
+    export SYSTEMD_MAN_SERVER=/tmp/man.sock
+    ninja man/systemd.directives.xml
+
+The tools forward their invocation to the server when
+$SYSTEMD_MAN_SERVER names a socket that accepts connections, and do the
+work themselves otherwise. The server runs requests one at a time, in
+the working directory of the client, and writes output files itself.
+
+Only the standard library is imported at the top, so that forward()
+is cheap to call.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import runpy
+import signal
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+SOCKET_ENV = 'SYSTEMD_MAN_SERVER'
+
+def forward(script):
+    """Run script with our arguments in the server, if there is one.
+
+    Returns the exit status of the remote run, or None if no server is
+    running and the caller should do the work itself.
+    """
+    path = os.environ.get(SOCKET_ENV)
+    if not path:
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    with sock:
+        try:
+            sock.connect(path)
+        except OSError:
+            return None
+        request = {'script': os.path.abspath(script),
+                   'args': sys.argv[1:],
+                   'cwd': os.getcwd()}
+        sock.sendall(json.dumps(request).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            reply = json.loads(f.read().decode('utf-8'))
+    sys.stdout.write(reply['stdout'])
+    sys.stderr.write(reply['stderr'])
+    return reply['status']
+
+class Server(socketserver.UnixStreamServer):
+    def __init__(self, path, man_dir, interval):
+        import man_data
+
+        self.man_data = man_data
+        self.man_dir = os.path.abspath(man_dir)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.stopping = threading.Event()
+        man_data.memory_cache = {}
+
+        old_umask = os.umask(0o077)
+        try:
+            super().__init__(path, Handler)
+        finally:
+            os.umask(old_umask)
+
+    def pages(self):
+        return sorted(os.path.join(self.man_dir, name)
+                      for name in os.listdir(self.man_dir)
+                      if name.endswith('.xml'))
+
+    def refresh(self):
+        "Parse new and changed pages, so that requests find them ready."
+        with self.lock:
+            fresh = set()
+            for (page, entities), entry in list(self.man_data.memory_cache.items()):
+                if os.path.exists(page) and self.man_data.cache_fresh(entry['deps']):
+                    fresh.add(page)
+                    continue
+                del self.man_data.memory_cache[page, entities]
+                if not os.path.exists(page):
+                    continue
+                os.chdir(entry['cwd'])
+                self.load([page])
+                fresh.add(page)
+            os.chdir(self.cwd)
+            self.load([page for page in self.pages() if page not in fresh])
+
+    def load(self, pages):
+        for page in pages:
+            try:
+                self.man_data.load_pages([page])
+            except ValueError as e:
+                # not every page can be indexed, let the tools complain
+                print(e, file=sys.stderr)
+
+    def watch(self):
+        while not self.stopping.wait(self.interval):
+            self.refresh()
+
+    def run(self, request):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        status = 0
+        with self.lock:
+            os.chdir(request['cwd'])
+            sys.argv = [request['script']] + request['args']
+            try:
+                with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                    runpy.run_path(request['script'], run_name='__main__')
+            except SystemExit as e:
+                if isinstance(e.code, int) or e.code is None:
+                    status = e.code or 0
+                else:
+                    print(e.code, file=stderr)
+                    status = 1
+            except Exception:
+                traceback.print_exc(file=stderr)
+                status = 1
+            finally:
+                os.chdir(self.cwd)
+        return {'status': status,
+                'stdout': stdout.getvalue(),
+                'stderr': stderr.getvalue()}
+
+    def serve(self):
+        self.cwd = os.getcwd()
+        self.refresh()
+        print('{}: {} pages loaded, serving on {}'.format(
+            sys.argv[0], len(self.man_data.memory_cache), self.server_address),
+              file=sys.stderr)
+        watcher = threading.Thread(target=self.watch, daemon=True)
+        watcher.start()
+        try:
+            self.serve_forever()
+        finally:
+            self.stopping.set()
+            os.unlink(self.server_address)
+
+def _in_use(path):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        return sock.connect_ex(path) == 0
+
+class Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        request = json.loads(self.rfile.readline().decode('utf-8'))
+        reply = self.server.run(request)
+        self.wfile.write(json.dumps(reply).encode('utf-8'))
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Serve the man page generators from memory')
+    p.add_argument('--socket', required=True,
+                   help='path of the Unix socket to listen on')
+    p.add_argument('--interval', type=float, default=1.0,
+                   help='seconds between checks for changed pages')
+    p.add_argument('man_dir', nargs='?', default='man',
+                   help='directory with the pages to keep loaded')
+    return p.parse_args()
+
+if __name__ == '__main__':
+    opts = parse_args()
+    # requests run the tools in this process, they must not forward
+    os.environ.pop(SOCKET_ENV, None)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    if os.path.exists(opts.socket):
+        # only replace a socket nobody listens on
+        if _in_use(opts.socket):
+            sys.exit('{} is in use'.format(opts.socket))
+        os.unlink(opts.socket)
+
+    server = Server(opts.socket, opts.man_dir, opts.interval)
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    with contextlib.suppress(KeyboardInterrupt):
+        server.serve()
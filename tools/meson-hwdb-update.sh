@@ -13,3 +13,4 @@ curl -L -o acpi_id_registry.html 'http://www.uefi.org/uefi-acpi-export'
 ./acpi-update.py > 20-acpi-vendor.hwdb.base
 patch -p0 -o- 20-acpi-vendor.hwdb.base <20-acpi-vendor.hwdb.patch >20-acpi-vendor.hwdb
 diff -u 20-acpi-vendor.hwdb.base 20-acpi-vendor.hwdb >20-acpi-vendor.hwdb.patch
+../src/udev/generate-keyboard-keys-list.sh cpp | sort >keyboard-keys.txt
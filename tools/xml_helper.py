@@ -18,18 +18,187 @@
 #  You should have received a copy of the GNU Lesser General Public License
 #  along with systemd; If not, see <http://www.gnu.org/licenses/>.
 
+import argparse
+import collections
+import concurrent.futures
+import os
+import re
+import threading
+import time
+from copy import deepcopy
 from lxml import etree as tree
 
+CUSTOM_ENTITIES = 'man/custom-entities.ent'
+XINCLUDE = '{http://www.w3.org/2001/XInclude}include'
+
+# How many entity and XInclude resolutions were served from the caches
+# below ('...-hits') and how many had to go to the disk ('...-misses').
+cache_stats = collections.Counter()
+
+# {(path, kind): ((mtime, size), data)}, shared by all threads
+_cache = {}
+_lock = threading.Lock()
+
+def _cached(path, kind, load):
+    st = os.stat(path)
+    stamp = st.st_mtime_ns, st.st_size
+    with _lock:
+        entry = _cache.get((path, kind))
+        if entry is not None and entry[0] == stamp:
+            cache_stats[kind + '-hits'] += 1
+            return entry[1]
+        cache_stats[kind + '-misses'] += 1
+    # two threads may load the same file at once, the result is the same
+    data = load(path)
+    with _lock:
+        _cache[path, kind] = stamp, data
+    return data
+
+def _read(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
 class CustomResolver(tree.Resolver):
     def resolve(self, url, id, context):
         if 'custom-entities.ent' in url:
-            return self.resolve_filename('man/custom-entities.ent', context)
+            data = _cached(CUSTOM_ENTITIES, 'entity', _read)
+            return self.resolve_string(data, context)
+
+def make_parser():
+    "Return a new parser which knows where to find custom-entities.ent."
+    parser = tree.XMLParser()
+    parser.resolvers.add(CustomResolver())
+    return parser
+
+_local = threading.local()
+
+def _thread_parser():
+    # lxml parsers must not be used by two threads at once
+    parser = getattr(_local, 'parser', None)
+    if parser is None:
+        parser = _local.parser = make_parser()
+    return parser
+
+class _Fragment:
+    """A parsed included document.
+
+    It is only read after loading, except for the ids cache which is
+    updated under _lock.
+    """
+    def __init__(self, doc):
+        self.doc = doc
+        self.ids = {}
+
+    def find_id(self, id):
+        with _lock:
+            nodes = self.ids.get(id)
+            if nodes is None:
+                # the id() XPath function sees the same IDs as XPointer
+                nodes = self.ids[id] = self.doc.xpath('id($id)', id=id)
+        return nodes
+
+def _load_fragment(path):
+    doc = tree.parse(path, _thread_parser())
+    _xinclude(doc)
+    return _Fragment(doc)
+
+def _load_text(path):
+    return _read(path).decode('utf-8')
+
+_NAME = re.compile(r'^[^\W\d][-\w.]*$')
+
+def _splice(include, nodes, text=None):
+    # like libxml2, replace include by nodes, keeping the text around it
+    parent = include.getparent()
+    index = parent.index(include)
+    for i, node in enumerate(nodes):
+        node.tail = None
+        parent.insert(index + i, node)
+    rest = (text or '') + (include.tail or '')
+    parent.remove(include)
+    if rest:
+        index += len(nodes)
+        if index > 0:
+            prev = parent[index - 1]
+            prev.tail = (prev.tail or '') + rest
+        else:
+            parent.text = (parent.text or '') + rest
+
+def _xinclude(doc):
+    """Process the <xi:include>s of doc, parsing each included file once.
+
+    Includes of whole files, of a single element by its id, and of text
+    are spliced in from the cache. Anything else is left to libxml2.
+    """
+    base = os.path.dirname(doc.docinfo.URL or '')
+    fallback = False
+    for include in list(doc.iter(XINCLUDE)):
+        href = include.get('href')
+        parse = include.get('parse', 'xml')
+        xpointer = include.get('xpointer')
+        if (not href or len(include) or include.getparent() is None or
+            parse not in ('xml', 'text') or
+            xpointer is not None and (parse == 'text' or not _NAME.match(xpointer))):
+            fallback = True
+            continue
+        path = os.path.join(base, href)
+        if parse == 'text':
+            _splice(include, [], _cached(path, 'text', _load_text))
+            continue
+
+        fragment = _cached(path, 'fragment', _load_fragment)
+        if xpointer is not None:
+            nodes = fragment.find_id(xpointer)
+        else:
+            root = fragment.doc.getroot()
+            nodes = (list(reversed(list(root.itersiblings(preceding=True)))) +
+                     [root] + list(root.itersiblings()))
+        _splice(include, [deepcopy(node) for node in nodes])
+
+    if fallback:
+        doc.xinclude()
 
-_parser = tree.XMLParser()
-_parser.resolvers.add(CustomResolver())
 def xml_parse(page):
-    doc = tree.parse(page, _parser)
-    doc.xinclude()
+    "Parse page and process its XIncludes. This may be called from any thread."
+    doc = tree.parse(page, _thread_parser())
+    _xinclude(doc)
     return doc
 def xml_print(xml):
     return tree.tostring(xml, pretty_print=True, encoding='utf-8')
+
+def _benchmark(pages, threads, repeat):
+    def run(executor):
+        best = None
+        for _ in range(repeat):
+            start = time.perf_counter()
+            if executor:
+                list(executor.map(xml_parse, pages))
+            else:
+                list(map(xml_parse, pages))
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best
+
+    run(None) # fill the caches
+    serial = run(None)
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        threaded = run(executor)
+
+    print('{} pages, best of {}'.format(len(pages), repeat))
+    print('serial:     {:8.1f} ms'.format(serial * 1000))
+    print('{:2} threads: {:8.1f} ms'.format(threads, threaded * 1000))
+    for key, count in sorted(cache_stats.items()):
+        print('{}: {}'.format(key, count))
+
+def parse_args():
+    p = argparse.ArgumentParser(description='Time parsing of man pages, serially and in threads')
+    p.add_argument('-t', '--threads', type=int, default=os.cpu_count() or 1)
+    p.add_argument('-r', '--repeat', type=int, default=5)
+    p.add_argument('pages', nargs='*')
+    return p.parse_args()
+
+if __name__ == '__main__':
+    # without arguments, this only checks that lxml is available
+    opts = parse_args()
+    if opts.pages:
+        _benchmark(opts.pages, opts.threads, opts.repeat)